@@ -1,10 +1,17 @@
 
 """Librispeech automatic speech recognition dataset."""
 
+import io
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import datasets
 
+from pitch import usable_cores
+
+logger = datasets.logging.get_logger(__name__)
+
 _CITATION = """\
 @inproceedings{panayotov2015librispeech,
   title={Librispeech: an ASR corpus based on public domain audio books},
@@ -29,34 +36,54 @@ _DL_URLS = {"test": _DL_URL + "test-clean.tar.gz",
             "train.100": _DL_URL + "train-clean-100.tar.gz",
         }
 
+# split -> directory under LibriSpeech/ in an extracted archive
+_SPLIT_DIRS = {"test": "test-clean", "train.100": "train-clean-100"}
+
 class LibrispeechASRConfig(datasets.BuilderConfig):
     """BuilderConfig for LibriSpeechASR."""
 
-    def __init__(self, **kwargs):
+    def __init__(self, decode=False, num_workers=None, prefetch=64, two_pass=False, **kwargs):
         """
         Args:
           data_dir: `string`, the path to the folder containing the files in the
-            downloaded .tar
+            downloaded .tar. If it holds an extracted tree (`LibriSpeech/train-clean-100/...`
+            or `train-clean-100/...`) that split is read from disk and nothing is downloaded.
+          decode: `bool`, decode FLAC to float32 arrays in the worker pool and store
+            `audio` as {path, array, sampling_rate} instead of encoded bytes.
+          num_workers: `int`, threads reading / decoding audio (default: usable cores).
+          prefetch: `int`, most examples read or decoded ahead of the one being yielded.
+          two_pass: `bool`, read the archive's transcripts in a first pass, for archives whose
+            members are not grouped by chapter (the default single pass buffers one chapter of audio).
           citation: `string`, citation for the data set
           url: `string`, url for information about the data set
           **kwargs: keyword arguments forwarded to super.
         """
         super(LibrispeechASRConfig, self).__init__(version=datasets.Version("2.1.0", ""), **kwargs)
+        self.decode = decode
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+        self.two_pass = two_pass
 
 class LibrispeechASR(datasets.GeneratorBasedBuilder):
     """Librispeech dataset."""
 
     DEFAULT_WRITER_BATCH_SIZE = 256
     DEFAULT_CONFIG_NAME = "all"
+    BUILDER_CONFIG_CLASS = LibrispeechASRConfig
     BUILDER_CONFIG = LibrispeechASRConfig(name="clean", description="'Clean' speech.")
 
     def _info(self):
+        if getattr(self.config, "decode", False):
+            audio = {"path": datasets.Value("string"), "array": datasets.Sequence(datasets.Value("float32")),
+                     "sampling_rate": datasets.Value("int64")}
+        else:
+            audio = datasets.Audio(sampling_rate=16_000)
         return datasets.DatasetInfo(
             description=_DESCRIPTION,
             features=datasets.Features(
                 {
                     "file": datasets.Value("string"),
-                    "audio": datasets.Audio(sampling_rate=16_000),
+                    "audio": audio,
                     "text": datasets.Value("string"),
                     "speaker_id": datasets.Value("int64"),
                     "chapter_id": datasets.Value("int64"),
@@ -69,6 +96,19 @@ class LibrispeechASR(datasets.GeneratorBasedBuilder):
         )
 
     def _split_generators(self, dl_manager):
+        local_dirs = {split: self._local_split_dir(split) for split in _DL_URLS}
+        missing = [_SPLIT_DIRS[split] for split, d in local_dirs.items() if d is None]
+        if getattr(self.config, "data_dir", None) and missing:
+            logger.warning(f"{', '.join(missing)} not found under data_dir={self.config.data_dir}; "
+                           "reading every split from the downloaded archives instead")
+        if not missing:
+            return [
+                datasets.SplitGenerator(
+                    name="train.100" if split == "train.100" else datasets.Split.TEST,
+                    gen_kwargs={"files": None, "local_extracted_archive": None, "local_dir": local_dirs[split]},
+                )
+                for split in ("train.100", "test")
+            ]
         archive_path = dl_manager.download(_DL_URLS)
         # (Optional) In non-streaming mode, we can extract the archive locally to have actual local audio files:
         local_extracted_archive = dl_manager.extract(archive_path) if not dl_manager.is_streaming else {}
@@ -93,40 +133,99 @@ class LibrispeechASR(datasets.GeneratorBasedBuilder):
         ]
         return train_split + test_split
 
-    def _generate_examples(self, files, local_extracted_archive):
-        """Generate examples from a LibriSpeech archive_path."""
-        key = 0
-        audio_data = {}
-        transcripts = []
+    def _local_split_dir(self, split):
+        data_dir = getattr(self.config, "data_dir", None)
+        if not data_dir:
+            return None
+        for candidate in (os.path.join(data_dir, _SPLIT_DIRS[split]), os.path.join(data_dir, "LibriSpeech", _SPLIT_DIRS[split])):
+            if os.path.isdir(candidate):
+                return candidate
+        return None
+
+    @staticmethod
+    def _transcripts(lines, directory=None):
+        for line in lines:
+            if isinstance(line, bytes):
+                line = line.decode("utf-8")
+            line = line.strip()
+            if line:
+                id_, transcript = line.split(" ", 1)
+                speaker_id, chapter_id = [int(el) for el in id_.split("-")[:2]]
+                yield {
+                    "id": id_,
+                    "speaker_id": speaker_id,
+                    "chapter_id": chapter_id,
+                    "file": os.path.join(directory, f"{id_}.flac") if directory else f"{id_}.flac",
+                    "text": transcript,
+                }
+
+    def _archive_pairs(self, files, local_extracted_archive):
+        """(transcript, flac bytes) pairs from the archive, read in a single pass."""
+        transcripts = {}
+        if local_extracted_archive:
+            for root, _, names in os.walk(local_extracted_archive):
+                for name in names:
+                    if name.endswith(".trans.txt"):
+                        with open(os.path.join(root, name), "r", encoding="utf-8") as f:
+                            transcripts.update((t["id"], t) for t in self._transcripts(f, root))
+        elif self.config.two_pass:
+            for path, f in files:
+                if path.endswith(".trans.txt"):
+                    transcripts.update((t["id"], t) for t in self._transcripts(f))
+        # a chapter's .flac members come before its .trans.txt, so only that chapter's audio waits here
+        single, pending = not (local_extracted_archive or self.config.two_pass), {}
         for path, f in files:
             if path.endswith(".flac"):
                 id_ = path.split("/")[-1][: -len(".flac")]
-                audio_data[id_] = f.read()
-            elif path.endswith(".trans.txt"):
-                for line in f:
-                    if line:
-                        line = line.decode("utf-8").strip()
-                        id_, transcript = line.split(" ", 1)
-                        audio_file = f"{id_}.flac"
-                        speaker_id, chapter_id = [int(el) for el in id_.split("-")[:2]]
-                        audio_file = (
-                            os.path.join(local_extracted_archive, audio_file)
-                            if local_extracted_archive
-                            else audio_file
-                        )
-                        transcripts.append(
-                            {
-                                "id": id_,
-                                "speaker_id": speaker_id,
-                                "chapter_id": chapter_id,
-                                "file": audio_file,
-                                "text": transcript,
-                            }
-                        )
-            if audio_data and len(audio_data) == len(transcripts):
-                for transcript in transcripts:
-                    audio = {"path": transcript["file"], "bytes": audio_data[transcript["id"]]}
-                    yield key, {"audio": audio, **transcript}
+                if id_ in transcripts:
+                    yield transcripts.pop(id_), f.read()
+                elif single:
+                    pending.setdefault(os.path.dirname(path), {})[id_] = f.read()
+            elif path.endswith(".trans.txt") and single:
+                audio = pending.pop(os.path.dirname(path), {})
+                for transcript in self._transcripts(f):
+                    if transcript["id"] in audio:
+                        yield transcript, audio.pop(transcript["id"])
+                    else:
+                        transcripts[transcript["id"]] = transcript
+
+    def _local_pairs(self, local_dir):
+        """(transcript, path) pairs from an extracted speaker/chapter tree; the audio is read by the workers."""
+        for root, dirs, names in os.walk(local_dir):
+            dirs.sort()
+            for name in sorted(names):
+                if name.endswith(".trans.txt"):
+                    with open(os.path.join(root, name), "r", encoding="utf-8") as f:
+                        for transcript in self._transcripts(f, root):
+                            yield transcript, transcript["file"]
+
+    def _load_audio(self, transcript, source):
+        """Runs on a worker: reads the file if given a path and decodes FLAC when config.decode is set."""
+        if self.config.decode:
+            import soundfile as sf
+
+            array, sampling_rate = sf.read(io.BytesIO(source) if isinstance(source, bytes) else source, dtype="float32")
+            return {"audio": {"path": transcript["file"], "array": array, "sampling_rate": sampling_rate}, **transcript}
+        if not isinstance(source, bytes):
+            with open(source, "rb") as f:
+                source = f.read()
+        return {"audio": {"path": transcript["file"], "bytes": source}, **transcript}
+
+    def _generate_examples(self, files, local_extracted_archive, local_dir=None):
+        """Generate examples from a LibriSpeech archive_path or an extracted local_dir. Audio is read / decoded
+        by a thread pool (libsndfile and file reads release the GIL) at most config.prefetch examples ahead,
+        and examples come out in input order."""
+        pairs = self._local_pairs(local_dir) if local_dir else self._archive_pairs(files, local_extracted_archive)
+        workers = getattr(self.config, "num_workers", None) or usable_cores()
+        prefetch = max(1, getattr(self.config, "prefetch", 64))
+        pending = deque()
+        key = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for transcript, source in pairs:
+                pending.append(pool.submit(self._load_audio, transcript, source))
+                if len(pending) >= prefetch:
+                    yield key, pending.popleft().result()
                     key += 1
-                audio_data = {}
-                transcripts = []
\ No newline at end of file
+            while pending:
+                yield key, pending.popleft().result()
+                key += 1
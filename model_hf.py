@@ -1,5 +1,10 @@
 import os
-import pyworld as pw
+import io
+import itertools
+import time
+import json
+import hashlib
+import heapq
 import math
 import warnings
 import logging
@@ -8,16 +13,21 @@ import torchaudio
 import torch.nn.functional as F
 import torch.nn.init as init
 from torch import nn, Tensor
+from torch.utils.data import IterableDataset
 import numpy as np
 import matplotlib.pyplot as plt
 from typing import Optional, Dict, Union, List, Tuple, Any
 from functools import partial
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
 from datetime import datetime
 from datasets import load_dataset, Audio
 from transformers.trainer_seq2seq import Seq2SeqTrainer
 from transformers.training_args_seq2seq import Seq2SeqTrainingArguments
 from dataclasses import dataclass
 from opimizer import MaxFactor
+from pitch import track_f0, yin_f0, usable_cores
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 dtype = torch.float32
@@ -169,6 +179,28 @@ def exists(v):
 def default(v, b):
     return v if exists(v) else b
 
+def conv_lengths(module: nn.Module, lengths):
+    """Output lengths of module's Conv1d layers, in registration order, for int or tensor lengths."""
+    for m in module.modules():
+        if isinstance(m, nn.Conv1d):
+            lengths = (lengths + 2 * m.padding[0] - m.dilation[0] * (m.kernel_size[0] - 1) - 1) // m.stride[0] + 1
+    return lengths
+
+def length_mask(lengths: Tensor, ctx: int) -> Tensor:
+    return torch.arange(ctx, device=lengths.device) < lengths.to(torch.long).unsqueeze(-1)
+
+def conv_stack(stack: nn.Sequential, x: Tensor, lengths: Optional[Tensor] = None) -> Tensor:
+    # frames past each sample's length are zeroed after every layer, like the convs' own zero padding
+    if lengths is None:
+        return stack(x)
+    lengths = lengths.to(x.device)
+    for m in stack:
+        x = m(x)
+        if isinstance(m, nn.Conv1d):
+            lengths = conv_lengths(m, lengths)
+        x = x * length_mask(lengths, x.shape[-1]).unsqueeze(1).to(x.dtype)
+    return x
+
 class Conv1d(nn.Conv1d):
     def _conv_forward(
         self, x: Tensor, weight: Tensor, bias) -> Tensor:
@@ -228,11 +260,71 @@ def sinusoids(length, channels, max_tscale=10000):
     scaled_t = torch.arange(length)[:, np.newaxis] * inv_tscales[np.newaxis, :]
     return torch.cat([torch.sin(scaled_t), torch.cos(scaled_t)], dim=1)
 
+def resample_rows(f0: Tensor, ctx: int, lengths: Optional[Tensor] = None, frames: Optional[Tensor] = None) -> Tensor:
+    # each row maps its own real f0 frames onto its own real ctx frames, then zero pads to ctx
+    batch, L = f0.shape
+    lengths = torch.full((batch,), L, device=f0.device) if lengths is None else lengths.to(f0.device)
+    frames = torch.full((batch,), ctx, device=f0.device) if frames is None else frames.to(f0.device).clamp(max=ctx)
+    lengths, frames = lengths.clamp(min=1), frames.clamp(min=1)
+    t = torch.arange(ctx, device=f0.device)
+    idx = (t[None, :] * (lengths.double() / frames.double())[:, None]).long()
+    idx = torch.minimum(idx, (lengths - 1)[:, None])
+    return f0.gather(1, idx) * (t[None, :] < frames[:, None])
+
+class PitchBias:
+    """exp(-|f0_i - f0_j|) attention bias over per-sample standardized f0, built once per encoder forward."""
+    # mode="lowrank" swaps the (ctx x ctx) table for `rank` random Fourier features, fed to attention as q/k channels
+    def __init__(self, f0: Tensor, mode: str = "full", rank: int = 64, seed: int = 0, mask: Optional[Tensor] = None):
+        f0 = f0.to(device, dtype)
+        self.f0 = f0.reshape(-1, f0.shape[-1])
+        self.mask = None if mask is None else mask.to(device).reshape(self.f0.shape)
+        self.mode = mode
+        self.rank = rank
+        self.seed = seed
+        self._tables = {}
+
+    def contour(self, ctx: int, frames: Optional[Tensor] = None) -> Tensor:
+        f0 = resample_rows(self.f0, ctx, None if self.mask is None else self.mask.sum(dim=-1), frames)
+        if frames is None:
+            return (f0 - f0.mean(dim=-1, keepdim=True)) / (f0.std(dim=-1, keepdim=True) + 1e-8)
+        # statistics over the real frames only, so padding does not move a sample's contour
+        mask = (torch.arange(ctx, device=f0.device)[None, :] < frames.to(f0.device)[:, None]).to(f0.dtype)
+        n = mask.sum(dim=-1, keepdim=True).clamp(min=1)
+        mean = (f0 * mask).sum(dim=-1, keepdim=True) / n
+        std = ((((f0 - mean) * mask) ** 2).sum(dim=-1, keepdim=True) / (n - 1).clamp(min=1)).sqrt()
+        return ((f0 - mean) / (std + 1e-8)) * mask
+
+    def dense(self, ctx: int, frames: Optional[Tensor] = None) -> Tensor:
+        # (batch, 1, ctx, ctx)
+        key = ("dense", ctx, None if frames is None else tuple(frames.tolist()))
+        if key not in self._tables:
+            if self.mode == "lowrank":
+                phi = self.features(ctx, frames)
+                self._tables[key] = phi @ phi.transpose(-1, -2)
+            else:
+                f0 = self.contour(ctx, frames)
+                self._tables[key] = torch.exp(-(f0.unsqueeze(-1) - f0.unsqueeze(-2)).abs()).unsqueeze(1)
+        return self._tables[key]
+
+    def features(self, ctx: int, frames: Optional[Tensor] = None) -> Tensor:
+        # (batch, 1, ctx, rank), with features @ features.T ~= dense(ctx)
+        key = ("features", ctx, None if frames is None else tuple(frames.tolist()))
+        if key not in self._tables:
+            gen = torch.Generator().manual_seed(self.seed)
+            omega = torch.distributions.Cauchy(0.0, 1.0).icdf(torch.rand(self.rank, generator=gen) * 0.998 + 0.001)
+            phase = torch.rand(self.rank, generator=gen) * 2 * math.pi
+            f0 = self.contour(ctx, frames).unsqueeze(-1)
+            phi = math.sqrt(2.0 / self.rank) * torch.cos(f0 * omega.to(f0) + phase.to(f0))
+            self._tables[key] = phi.unsqueeze(1)
+        return self._tables[key]
+
 class rotary(nn.Module):
+    cache_size = 4
     def __init__(self, dims, head, max_ctx=1500, theta=10000, radii=True, debug: List[str] = [], use_pbias=False):
         super(rotary, self).__init__()
 
         self.use_pbias = use_pbias
+        self.max_ctx = max_ctx
         self.dims = dims
         self.head = head
         self.head_dim = dims // head
@@ -242,11 +334,12 @@ class rotary(nn.Module):
         self.counter = 0
         self.last_theta = None
         self.theta = nn.Parameter(torch.tensor(theta, device=device, dtype=dtype), requires_grad=True)
+        self._tables = OrderedDict()
+        self._f0_table = None
 
     def theta_freqs(self, theta):
         freq = (theta / 220.0) * 700 * (torch.pow(10, torch.linspace(0, 2595 * torch.log10(torch.tensor(1 + 8000/700)), self.dim // 2, device=device, dtype=dtype) / 2595) - 1) / 1000
-        freqs = nn.Parameter(torch.tensor(freq, device=device, dtype=dtype), requires_grad=True)        
-        return freqs
+        return freq
 
     def mel_scale_scalar(freq: float) -> float:
         return 1127.0 * math.log(1.0 + freq / 700.0)
@@ -266,13 +359,9 @@ class rotary(nn.Module):
     def get_pitch_bias(self, f0):
         if f0 is None:
             return None
-        f0_flat = f0.squeeze().float()
-        f0_norm = (f0_flat - f0_flat.mean()) / (f0_flat.std() + 1e-8)
-        f0_sim = torch.exp(-torch.cdist(f0_norm.unsqueeze(1), 
-                                    f0_norm.unsqueeze(1)))
-        return f0_sim.unsqueeze(0).unsqueeze(0)
+        return PitchBias(f0).dense(f0.shape[-1])
 
-    def forward(self, x=None, enc=None, layer=None, feature_type="audio") -> Tensor:
+    def forward(self, x=None, enc=None, layer=None, feature_type="audio", offset=0, key_mask=None) -> Tensor:
         f0 = enc.get("f0") if enc is not None else None 
         if isinstance(x, int):
             ctx = x
@@ -282,47 +371,74 @@ class rotary(nn.Module):
             batch, ctx, dims = x.shape
         else:
             batch, head, ctx, head_dim = x.shape
-        t = torch.arange(ctx, device=device, dtype=dtype)
 
-        if f0 is not None and f0.dim() == 2:
-            if f0.shape[0] == 1: 
-                f0 = f0.squeeze(0)  
-            else:
-                f0 = f0.view(-1)        
+        f0_mask = enc.get("f0_mask") if f0 is not None else None
+        frames = key_mask.sum(dim=-1) if f0 is not None and key_mask is not None else None
+        freqs = self.table(offset + ctx, f0=f0, layer=layer, mask=f0_mask, frames=frames)[:, offset:offset + ctx]
+        self.counter += 1
+        return freqs.unsqueeze(1)
+
+    def table(self, ctx, f0=None, layer=None, mask=None, frames=None) -> Tensor:
+        """(batch, ctx, dim // 2) complex table, cached per layer: every MultiheadA owns its rotary and theta."""
+        # f0-free rows only depend on position, so one max_ctx table serves every length. An f0 table belongs 
+        # to one batch, so only the latest is kept and is shared by this layer's q and k. Keys carry the theta 
+        # version, so an optimizer step invalidates them.
+        version = (self.theta._version, self.theta.data_ptr(), device, dtype)
+        if f0 is not None:
+            key = (ctx, f0._version) + version
+            hit = self._f0_table
+            if (hit is not None and hit[0] is f0 and hit[1] is mask and hit[2] == key 
+                    and (hit[3] is frames or (hit[3] is not None and frames is not None and torch.equal(hit[3], frames)))):
+                return hit[4]
+            freqs = self.compute_freqs(ctx, f0=f0, layer=layer, mask=mask, frames=frames)
+            self._f0_table = (f0, mask, key, frames, freqs)
+            return freqs
+
+        hit = self._tables.get(version)
+        if hit is not None and hit.shape[1] >= ctx:
+            self._tables.move_to_end(version)
+            return hit
+        freqs = self.compute_freqs(max(ctx, self.max_ctx), layer=layer)
+        self._tables[version] = freqs
+        self._tables.move_to_end(version)
+        while len(self._tables) > self.cache_size:
+            self._tables.popitem(last=False)
+        return freqs
+
+    @torch.no_grad()
+    def compute_freqs(self, ctx, f0=None, layer=None, mask=None, frames=None) -> Tensor:
+        t = torch.arange(ctx, device=device, dtype=dtype)
 
         if f0 is not None:
-            f0_mean = f0.mean()
-            theta = f0_mean + self.theta
+            f0 = f0.to(device, dtype)
+            f0 = f0.reshape(-1, f0.shape[-1])
+            if mask is not None:
+                mask = mask.to(device).reshape(f0.shape)
+                theta = (f0 * mask).sum(dim=-1, keepdim=True) / mask.sum(dim=-1, keepdim=True).clamp(min=1) + self.theta
+            else:
+                theta = f0.mean(dim=-1, keepdim=True) + self.theta
         else:
-            theta = self.theta 
+            theta = self.theta.view(1, 1)
 
         freqs = self.theta_freqs(theta)
 
-        freqs = t[:, None] * freqs[None, :]
+        freqs = t[None, :, None] * freqs[:, None, :]
 
         if self.radii and f0 is not None:
-            radius = f0.to(device, dtype)
-            L = radius.shape[0]
-            if L != ctx:
-                F = L / ctx
-                idx = torch.arange(ctx, device=f0.device)
-                idx = (idx * F).long().clamp(0, L - 1)
-                radius = radius[idx]
+            radius = resample_rows(f0, ctx, None if mask is None else mask.sum(dim=-1), frames)
             freqs = torch.polar(radius.unsqueeze(-1).expand_as(freqs), freqs)
         else:
             freqs = torch.polar(torch.ones_like(freqs), freqs)
 
         if "radius" in self.debug and self.counter % 100 == 0:
-            theta_value = theta.item() if isinstance(theta, torch.Tensor) else theta
+            theta_value = theta.mean().item()
             print(f"  [{layer}] [Radius] {radius.shape} {radius.mean():.2f} [Theta] {theta_value:.2f} [f0] {f0.shape if f0 is not None else None} [Freqs] {freqs.shape} {freqs.mean():.2f} [ctx] {ctx}")
         
         if "theta" in self.debug and self.counter % 100 == 0:
-            if self.last_theta is None or abs(self.last_theta - theta.item()) > 1.0:
-                self.last_theta = theta.item()
+            if self.last_theta is None or abs(self.last_theta - theta.mean().item()) > 1.0:
+                self.last_theta = theta.mean().item()
                 print(f"[Theta] {self.last_theta:.2f}")
-
-        self.counter += 1
-        return freqs.unsqueeze(0)
+        return freqs
 
     @staticmethod
     def apply_rotary(x, freqs):
@@ -340,6 +456,7 @@ class rotary(nn.Module):
 class MultiheadA(nn.Module):
     _seen = set()  
     rbf = False
+    sdpa = True
     def __init__(self, dims: int, head: int, rotary_emb: bool = True, 
                  zero_val: float = 1e-4, minz: float = 1e-6, maxz: float = 1e-3, debug: List[str] = [], optim_attn=False):
         super(MultiheadA, self).__init__()
@@ -369,6 +486,7 @@ class MultiheadA(nn.Module):
                 head=head,
                 debug=debug,
                 radii=True,
+                use_pbias="pbias" in debug,
                 )
         else:
             self.rope = None
@@ -394,7 +512,25 @@ class MultiheadA(nn.Module):
         rbf_scores = torch.exp(-dist_sq / (2 * rbf_sigma**2))
         return (1 - rbf_ratio) * dot_scores + rbf_ratio * rbf_scores
           
-    def forward(self, x: Tensor, xa: Tensor = None, mask: Tensor = None, enc = None, layer = None, feature_type="audio", need_weights=True) -> tuple:
+    def project_kv(self, z: Tensor, enc=None, layer=None, offset: int = 0, key_mask=None) -> Tuple[Tensor, Tensor]:
+        k = self.k(z)
+        v = self.v(z)
+        k = k.view(*k.shape[:2], self.head, -1).permute(0, 2, 1, 3)
+        v = v.view(*v.shape[:2], self.head, -1).permute(0, 2, 1, 3)
+        if self.rotary_emb:
+            k = self.rope.apply_rotary(k, (self.rope(k.shape[2], enc=enc, layer=layer, offset=offset, key_mask=key_mask)))
+        return k, v
+
+    def memory(self, xa: Tensor, kv_cache: dict, enc=None, layer=None, key_mask=None) -> Tuple[Tensor, Tensor]:
+        # cross-attention K/V of xa, kept in kv_cache as (xa, k, v) while the same encoder output comes in
+        xa = xa.to(device, dtype)
+        entry = kv_cache.get(self)
+        if entry is None or entry[0] is not xa:
+            entry = kv_cache[self] = (xa, *self.project_kv(xa, enc=enc, layer=layer, key_mask=key_mask))
+        return entry[1], entry[2]
+
+    def forward(self, x: Tensor, xa: Tensor = None, mask: Tensor = None, enc = None, layer = None, feature_type="audio", 
+                need_weights=False, kv_cache: Optional[dict] = None, offset: int = 0, key_mask: Optional[Tensor] = None) -> tuple:
 
         x = x.to(device, dtype)
         if xa is not None:
@@ -403,47 +539,83 @@ class MultiheadA(nn.Module):
         
         z = default(xa, x).to(device, dtype)
         q = self.q(x)
-        k = self.k(z)
-        v = self.v(z)
-
-        if self.rotary_emb:   
-            q = q.view(*q.shape[:2], self.head, -1).permute(0, 2, 1, 3)
-            k = k.view(*k.shape[:2], self.head, -1).permute(0, 2, 1, 3)
-            v = v.view(*v.shape[:2], self.head, -1).permute(0, 2, 1, 3)
-            q2 = q.shape[2]
-            k2 = k.shape[2]
+        q = q.view(*q.shape[:2], self.head, -1).permute(0, 2, 1, 3)
+        if self.rotary_emb:
+            q = self.rope.apply_rotary(q, (self.rope(q.shape[2], enc=enc, layer=layer, offset=offset, 
+                                                     key_mask=key_mask if xa is None else None)))
 
-            q = self.rope.apply_rotary(q, (self.rope(q2, enc=enc, layer=layer)))
-            k = self.rope.apply_rotary(k, (self.rope(k2, enc=enc, layer=layer)))
+        if kv_cache is not None and xa is not None:
+            k, v = self.memory(xa, kv_cache, enc=enc, layer=layer, key_mask=key_mask)
         else:
-            q = q.view(*q.shape[:2], self.head, -1).permute(0, 2, 1, 3)
-            k = k.view(*k.shape[:2], self.head, -1).permute(0, 2, 1, 3)
-            v = v.view(*v.shape[:2], self.head, -1).permute(0, 2, 1, 3)
-            batch, head, ctx, head_dim = q.shape
-        
-        if self.rbf:
-            qk = self.rbf_scores(q * scale, k * scale, rbf_sigma=1.0, rbf_ratio=0.3)
-        
-        qk = (q * scale) @ (k * scale).transpose(-1, -2)
-        if self.rope.use_pbias:
-            f0 = enc.get("f0", None) if enc is not None else None
-            pbias = self.rope.use_pbias(f0)
-            if pbias is not None:
-                qk = qk + pbias[:,:,:q2,:q2]
-        token_ids = k[:, :, :, 0]
-        zscale = torch.ones_like(token_ids)
-        fzero = torch.clamp(F.softplus(self.fzero), self.minz, self.maxz)
-        zscale[token_ids.float() == self.pad_token] = fzero
+            k, v = self.project_kv(z, enc=enc, layer=layer, offset=offset if xa is None else 0, key_mask=key_mask)
+
+        if kv_cache is not None and xa is None:
+            if self in kv_cache:
+                k = torch.cat([kv_cache[self][0], k], dim=2)
+                v = torch.cat([kv_cache[self][1], v], dim=2)
+            kv_cache[self] = (k, v)
+        q2 = q.shape[2]
+        k2 = k.shape[2]
+
+        group = q.shape[0] // k.shape[0]
+        if group > 1:
+            q = q.view(k.shape[0], group, *q.shape[1:]).transpose(1, 2).flatten(2, 3)
         
+        pitch = enc.get("pbias") if self.rope.use_pbias and enc is not None and xa is None else None
+        fast = self.sdpa and not need_weights and not self.rbf
+        pbias = None
+        frames = None if pitch is None or key_mask is None else key_mask.sum(dim=-1)
+        if pitch is not None and not (fast and pitch.mode == "lowrank"):
+            pbias = pitch.dense(k2, frames)[:, :, offset:offset + q2, :k2]
         if mask is not None:
-            mask = mask[:q2, :q2]
-            qk = qk + mask.unsqueeze(0).unsqueeze(0) * zscale.unsqueeze(-2).expand(qk.shape)
-        qk = qk * zscale.unsqueeze(-2)
-        w = F.softmax(qk, dim=-1).to(q.dtype)
-        wv = (w @ v).permute(0, 2, 1, 3).flatten(start_dim=2)
+            mask = mask[offset:offset + q2, :k2]
+
+        if key_mask is not None:
+            # real padding from the collator lengths: padded keys are dropped, not guessed and rescaled
+            zscale = torch.ones_like(k[:, :, :, 0])
+            pad = torch.zeros(key_mask.shape, device=k.device, dtype=k.dtype).masked_fill(~key_mask, -np.inf)[:, None, None, :]
+        else:
+            token_ids = k[:, :, :, 0]
+            fzero = torch.clamp(F.softplus(self.fzero), self.minz, self.maxz)
+            zscale = torch.where(token_ids.float() == self.pad_token, fzero, torch.ones_like(token_ids))
+            pad = None
+
+        if fast:
+            # (qk + pbias + mask * z) * z with a per-key z is q @ (k * z).T plus an additive mask; the 
+            # causal mask only holds 0 / -inf so mask * z * z == mask.
+            k = k * zscale.unsqueeze(-1)
+            attn_mask = None if pbias is None else pbias * zscale.unsqueeze(-2)
+            if pitch is not None and pbias is None:
+                # low-rank bias rides along as extra channels: s * [q, phi / sqrt(s)] . [k, phi / sqrt(s)]
+                phi = pitch.features(k2, frames).expand(k.shape[0], self.head, -1, -1) / scale
+                q = torch.cat([q, phi[:, :, offset:offset + q2]], dim=-1)
+                k = torch.cat([k, phi * zscale.unsqueeze(-1)], dim=-1)
+            for m in (mask, pad):
+                if m is not None:
+                    attn_mask = m if attn_mask is None else attn_mask + m
+            wv = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, scale=scale ** 2)
+            qk = None
+        else:
+            if self.rbf:
+                qk = self.rbf_scores(q * scale, k * scale, rbf_sigma=1.0, rbf_ratio=0.3)
+            
+            qk = (q * scale) @ (k * scale).transpose(-1, -2)
+            if pbias is not None:
+                qk = qk + pbias
+            
+            if mask is not None:
+                qk = qk + mask.unsqueeze(0).unsqueeze(0) * zscale.unsqueeze(-2).expand(qk.shape)
+            qk = qk * zscale.unsqueeze(-2)
+            if pad is not None:
+                qk = qk + pad
+            w = F.softmax(qk, dim=-1).to(q.dtype)
+            wv = w @ v
+        if group > 1:
+            wv = wv.view(k.shape[0], self.head, group, q2, -1).transpose(1, 2).flatten(0, 1)
+        wv = wv.permute(0, 2, 1, 3).flatten(start_dim=2)
         
         if "multihead" in self.debug and self.counter % 100 == 0:
-            print(f"MHA: q={q.shape}, k={k.shape}, v={v.shape} - {qk.shape}, wv shape: {wv.shape}")
+            print(f"MHA: q={q.shape}, k={k.shape}, v={v.shape} - {qk.shape if qk is not None else None}, wv shape: {wv.shape}")
         self.counter += 1        
         return self.o(wv), qk
 
@@ -547,12 +719,15 @@ class Residual(nn.Module):
         if not any([t_gate, m_gate, c_gate]):
             self.mlp_gate = nn.Sequential(Linear(dims, 1), nn.Sigmoid())
 
-    def forward(self, x, xa=None, mask=None, enc=None, layer=None, feature_type="audio") -> Tensor:
+    def forward(self, x, xa=None, mask=None, enc=None, layer=None, feature_type="audio", kv_cache=None, offset=0, 
+                memory=None, key_mask=None, xa_mask=None) -> Tensor:
 
-        x = x + self.attna(self.lna(x), xa=None, mask=mask, enc=enc, layer=layer)[0]
+        x = x + self.attna(self.lna(x), xa=None, mask=mask, enc=enc, layer=layer, kv_cache=kv_cache, offset=offset, 
+                           key_mask=key_mask)[0]
         xb = x
         if self.attnb and xa is not None:
-            x = x + self.attnb(self.lnb(x), xa=xa, mask=None, enc=enc, layer=layer)[0]
+            x = x + self.attnb(self.lnb(x), xa=xa, mask=None, enc=enc, layer=layer, kv_cache=memory, offset=offset, 
+                               key_mask=xa_mask)[0]
             
             if self.do_blend:
                 b = torch.sigmoid(self.blend)
@@ -596,6 +771,136 @@ class Residual(nn.Module):
         self.counter += 1      
         return x
 
+class FusedResidual:
+    """N same-shaped Residual layers run as one, x being (N, batch, ctx, dims) and each Linear one bmm."""
+    # weights are stacked from the Residuals' own parameters, so checkpoints keep the unfused layout
+    def __init__(self, blocks: List[Residual]):
+        self.blocks = list(blocks)
+        self._stacks = {}
+
+    @staticmethod
+    def supported(blocks: List[Residual], enc=None) -> bool:
+        if len(blocks) < 2 or not MultiheadA.sdpa or MultiheadA.rbf:
+            return False
+        pitch = enc is not None and "pbias" in enc
+        attns = [b.attna for b in blocks] + [b.attnb for b in blocks if b.attnb is not None]
+        return (all(a.rotary_emb and not (pitch and a.rope.use_pbias) for a in attns) and 
+                len({b.attnb is None for b in blocks}) == 1 and len({b.skip_gates for b in blocks}) == 1)
+
+    def w(self, name: str) -> Tensor:
+        params = [b.get_parameter(name) for b in self.blocks]
+        if torch.is_grad_enabled() and any(p.requires_grad for p in params):
+            return torch.stack(params)
+        key = tuple((p.data_ptr(), p._version) for p in params)
+        hit = self._stacks.get(name)
+        if hit is None or hit[0] != key:
+            hit = self._stacks[name] = (key, torch.stack([p.detach() for p in params]))
+        return hit[1]
+
+    def linear(self, x: Tensor, name: str, bias: bool = True) -> Tensor:
+        weight = self.w(f"{name}.weight").to(x.dtype)
+        x2 = x.reshape(x.shape[0], -1, x.shape[-1])
+        if bias:
+            y = torch.baddbmm(self.w(f"{name}.bias").to(x.dtype).unsqueeze(1), x2, weight.transpose(1, 2))
+        else:
+            y = torch.bmm(x2, weight.transpose(1, 2))
+        return y.view(*x.shape[:-1], -1)
+
+    def norm(self, x: Tensor, name: str) -> Tensor:
+        norm = self.blocks[0].get_submodule(name)
+        weight = self.w(f"{name}.weight").to(x.dtype)
+        return F.rms_norm(x, norm.normalized_shape, None, norm.eps) * weight.view(weight.shape[0], *[1] * (x.ndim - 2), -1)
+
+    def heads(self, x: Tensor, head: int) -> Tensor:
+        return x.view(*x.shape[:3], head, -1).transpose(2, 3)
+
+    def rope(self, x: Tensor, name: str, enc=None, layer=None, offset: int = 0, key_mask=None) -> Tensor:
+        masks = key_mask.expand(len(self.blocks), *key_mask.shape[-2:]) if key_mask is not None else [None] * len(self.blocks)
+        freqs = torch.stack([b.get_submodule(name).rope(x.shape[3], enc=enc, layer=layer, offset=offset, key_mask=m) 
+                             for b, m in zip(self.blocks, masks)])
+        return rotary.apply_rotary(x, freqs)
+
+    def project_kv(self, z: Tensor, name: str, head: int, enc=None, layer=None, offset: int = 0, 
+                   key_mask=None) -> Tuple[Tensor, Tensor]:
+        k = self.heads(self.linear(z, f"{name}.k", bias=False), head)
+        v = self.heads(self.linear(z, f"{name}.v"), head)
+        return self.rope(k, name, enc=enc, layer=layer, offset=offset, key_mask=key_mask), v
+
+    def attention(self, x: Tensor, name: str, xa: Optional[Tensor] = None, mask=None, enc=None, layer=None, 
+                  kv_cache=None, offset: int = 0, key_mask: Optional[Tensor] = None) -> Tensor:
+        attn = self.blocks[0].get_submodule(name)
+        head, scale = attn.head, (attn.dims // attn.head) ** -0.5
+        N = x.shape[0]
+        q = self.rope(self.heads(self.linear(x, f"{name}.q"), head), name, enc=enc, layer=layer, offset=offset, 
+                      key_mask=key_mask if xa is None else None)
+
+        if xa is None:
+            k, v = self.project_kv(x, name, head, enc=enc, layer=layer, offset=offset, key_mask=key_mask)
+            if kv_cache is not None:
+                # cached batch-first so Echo._reorder_cache can index_select beams along dim 0
+                if self in kv_cache:
+                    k = torch.cat([kv_cache[self][0].transpose(0, 1), k], dim=3)
+                    v = torch.cat([kv_cache[self][1].transpose(0, 1), v], dim=3)
+                kv_cache[self] = (k.transpose(0, 1), v.transpose(0, 1))
+        else:
+            entry = kv_cache.get(self) if kv_cache is not None else None
+            if entry is None or entry[0] is not xa:
+                z = xa.expand(N, *xa.shape[-3:]) if xa.ndim == 3 else xa
+                entry = (xa, *self.project_kv(z.to(device, dtype), name, head, enc=enc, layer=layer, key_mask=key_mask))
+                if kv_cache is not None:
+                    kv_cache[self] = entry
+            k, v = entry[1], entry[2]
+
+        q2, batch = q.shape[3], k.shape[1]
+        group = q.shape[1] // batch
+        if group > 1:
+            q = q.view(N, batch, group, *q.shape[2:]).transpose(2, 3).flatten(3, 4)
+        if mask is not None:
+            mask = mask[offset:offset + q2, :k.shape[3]]
+
+        if key_mask is not None:
+            key_mask = key_mask.expand(N, *key_mask.shape[-2:])
+            pad = torch.zeros(key_mask.shape, device=k.device, dtype=k.dtype).masked_fill(~key_mask, -np.inf)
+            pad = pad.flatten(0, 1)[:, None, None, :]
+            mask = pad if mask is None else mask + pad
+        else:
+            fzero = torch.clamp(F.softplus(self.w(f"{name}.fzero")), attn.minz, attn.maxz).view(N, 1, 1, 1)
+            k = k * torch.where(k[..., 0].float() == attn.pad_token, fzero, torch.ones_like(k[..., 0])).unsqueeze(-1)
+        wv = F.scaled_dot_product_attention(q.flatten(0, 1), k.flatten(0, 1), v.flatten(0, 1), 
+                                            attn_mask=mask, scale=scale).view(N, batch, head, -1, v.shape[-1])
+        if group > 1:
+            wv = wv.view(N, batch, head, group, q2, -1).transpose(2, 3).flatten(1, 2)
+        return self.linear(wv.transpose(2, 3).flatten(3), f"{name}.o")
+
+    def t_gate(self, x: Tensor) -> Tensor:
+        gate = self.blocks[0].t_gate
+        types = len(gate.gate_projections)
+        weight = torch.cat([self.w(f"t_gate.gate_projections.{i}.0.linear.weight") for i in range(types)], dim=1)
+        bias = torch.cat([self.w(f"t_gate.gate_projections.{i}.0.linear.bias") for i in range(types)], dim=1)
+        x2 = x.reshape(x.shape[0], -1, x.shape[-1])
+        gates = torch.sigmoid(torch.baddbmm(bias.unsqueeze(1), x2, weight.transpose(1, 2))).view(*x.shape[:-1], types)
+        type_probs = F.softmax(self.linear(x, "t_gate.type_classifier.0.linear"), dim=-1)
+        return torch.sum(gates * type_probs, dim=-1, keepdim=True)
+
+    def __call__(self, x: Tensor, xa: Optional[Tensor] = None, mask=None, enc=None, layer=None, kv_cache=None, 
+                 offset: int = 0, memory=None, key_mask=None, xa_mask=None) -> Tensor:
+        first = self.blocks[0]
+        x = x + self.attention(self.norm(x, "lna"), "attna", mask=mask, enc=enc, layer=layer, kv_cache=kv_cache, offset=offset, 
+                               key_mask=key_mask)
+        xb = x
+        if first.attnb is not None and xa is not None:
+            x = x + self.attention(self.norm(x, "lnb"), "attnb", xa=xa, enc=enc, layer=layer, kv_cache=memory, offset=offset, 
+                                   key_mask=xa_mask)
+            if first.do_blend:
+                b = torch.sigmoid(self.w("blend")).view(-1, *[1] * (x.ndim - 1))
+                x = b * xb + (1 - b) * x
+
+        normx = self.norm(x, "lnc")
+        mlp_out = self.linear(first.mlp[1](self.linear(normx, "mlp.0.linear")), "mlp.2.linear")
+        if first.skip_gates:
+            return x + mlp_out
+        return x + self.t_gate(normx) * mlp_out
+
 class FEncoder(nn.Module):
     def __init__(self, input_dims, dims, head, layer, kernel_size, act, stride=1, use_rope=False, spec_shape=None):
         super().__init__()
@@ -644,8 +949,8 @@ class FEncoder(nn.Module):
         x = x.permute(0, 2, 1, 3).contiguous().view(batch, ctx, dims)
         return x
 
-    def forward(self, x, enc=None, layer=None, feature_type="audio"):
-        x = self.encoder(x).permute(0, 2, 1)
+    def forward(self, x, enc=None, layer=None, feature_type="audio", lengths=None):
+        x = conv_stack(self.encoder, x, lengths).permute(0, 2, 1)
         if self.use_rope:
             x = self.apply_rope_to_features(x, layer=layer, feature_type=feature_type)
         else:
@@ -695,9 +1000,9 @@ class WEncoder(nn.Module):
         x = x.permute(0, 2, 1, 3).contiguous().view(batch, ctx, dims)
         return x
         
-    def forward(self, x, enc=None, layer=None, feature_type="waveform"):
-        x = self.downsample(x)
-        x = self.encoder(x)
+    def forward(self, x, enc=None, layer=None, feature_type="waveform", lengths=None):
+        x = conv_stack(self.downsample, x, lengths)
+        x = conv_stack(self.encoder, x, None if lengths is None else conv_lengths(self.downsample, lengths))
         x = x.permute(0, 2, 1)
         if self.use_rope:
             x = self.apply_rope_to_features(x, layer=layer)
@@ -744,8 +1049,8 @@ class PEncoder(nn.Module):
         x = x.permute(0, 2, 1, 3).contiguous().view(batch, ctx, dims)
         return x
         
-    def forward(self, x, enc=None, layer=None, feature_type="pitch"):
-        x = self.encoder(x).permute(0, 2, 1)
+    def forward(self, x, enc=None, layer=None, feature_type="pitch", lengths=None):
+        x = conv_stack(self.encoder, x, lengths).permute(0, 2, 1)
         if self.use_rope:
             x = self.apply_rope_to_features(x, layer=layer)
         else:
@@ -754,8 +1059,23 @@ class PEncoder(nn.Module):
         x = self.norm(x)
         return x
 
+_branch_pool = None
+
+def branch_pool(workers: int) -> ThreadPoolExecutor:
+    """Shared threads for running independent encoder branches."""
+    global _branch_pool
+    if _branch_pool is None or _branch_pool._max_workers != workers:
+        if _branch_pool is not None:
+            _branch_pool.shutdown(wait=False)
+        _branch_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="echo-branch")
+    return _branch_pool
+
 class AudioEncoder(nn.Module):
     _seen = set()  
+    concurrent = False
+    fused = False
+    pbias_mode = "full"
+    pbias_rank = 64
     def __init__(self, mels: int, ctx: int, dims: int, head: int, layer: int, debug: List[str], features: List[str], act: str = "gelu"):
         super(AudioEncoder, self).__init__()
 
@@ -803,18 +1123,84 @@ class AudioEncoder(nn.Module):
             [Residual(ctx=ctx, dims=dims, head=head, act=act, debug=debug, features=features, cgate=cgate) for _ in range(layer)] 
             if "phase" in features else None),
             })
+        self._fused = {}
 
-    def forward(self, enc, layer="encoder"):
-        enc = dict_to(enc, device, dtype)
+    def branch(self, f, enc, layer="encoder", grad=True, key_mask=None, lengths=None):
+        with torch.set_grad_enabled(grad):
+            x = self.blocks[f][0](enc[f], enc=enc, layer=layer, lengths=lengths)
+            for block in self.blocks[f][1:]:
+                x = block(x, enc=enc, layer=layer, key_mask=key_mask)
+        return x
+
+    def fused_forward(self, branches, enc, layer="encoder", masks=None, lengths=None) -> Dict[str, Tensor]:
+        # branches whose front-end outputs share a shape run their Residual stacks as one FusedResidual per layer
+        masks, lengths = default(masks, {}), default(lengths, {})
+        xs = {f: self.blocks[f][0](enc[f], enc=enc, layer=layer, lengths=lengths.get(f)) for f in branches}
+        groups = {}
+        for f in branches:
+            groups.setdefault(tuple(xs[f].shape), []).append(f)
         out = {}
-        out.update(enc)
+        for group in groups.values():
+            layers = [[self.blocks[f][i] for f in group] for i in range(1, len(self.blocks[group[0]]))]
+            if not all(FusedResidual.supported(blocks, enc) for blocks in layers):
+                for f in group:
+                    x = xs[f]
+                    for block in self.blocks[f][1:]:
+                        x = block(x, enc=enc, layer=layer, key_mask=masks.get(f))
+                    out[f] = x
+                continue
+            key_mask = torch.stack([masks[f] for f in group]) if all(masks.get(f) is not None for f in group) else None
+            x = torch.stack([xs[f] for f in group])
+            for i, blocks in enumerate(layers):
+                key = (tuple(group), i)
+                if key not in self._fused:
+                    self._fused[key] = FusedResidual(blocks)
+                x = self._fused[key](x, enc=enc, layer=layer, key_mask=key_mask)
+            out.update(zip(group, x.unbind(0)))
+        return out
 
+    def frame_masks(self, enc, lengths) -> Dict[str, Tensor]:
+        masks = {}
         for f in self.features:
-            if f in enc and f in self.blocks:
-                x = enc[f]
-                for block in self.blocks[f]:
-                    x = block(x, enc=enc, layer=layer)
-                out[f] = x
+            if f in enc and f in self.blocks and f in lengths:
+                front = self.blocks[f][0]
+                masks[f] = length_mask(conv_lengths(front, lengths[f].to(device)), conv_lengths(front, enc[f].shape[-1]))
+        return masks
+
+    def forward(self, enc, layer="encoder", lengths: Optional[Dict[str, Tensor]] = None):
+        enc = dict_to(enc, device, dtype)
+        masks, lengths = {}, default(lengths, {})
+        if lengths:
+            # frames past the longest sample are padding for every row: drop them before any compute
+            enc = {k: v[..., :int(lengths[k].max())] if k in lengths and isinstance(v, Tensor) else v for k, v in enc.items()}
+            if enc.get("f0") is not None and "f0" in lengths:
+                enc["f0_mask"] = length_mask(lengths["f0"].to(device), enc["f0"].shape[-1])
+            masks = self.frame_masks(enc, lengths)
+        out = {}
+        out.update(enc)
+        if "pbias" in self.debug and enc.get("f0") is not None:
+            enc["pbias"] = PitchBias(enc["f0"], mode=self.pbias_mode, rank=self.pbias_rank, mask=enc.get("f0_mask"))
+
+        branches = [f for f in self.features if f in enc and f in self.blocks]
+        grad = torch.is_grad_enabled()
+        if self.fused and len(branches) > 1:
+            out.update(self.fused_forward(branches, enc, layer, masks, lengths))
+        elif self.concurrent and len(branches) > 1 and usable_cores() > 1:
+            pool = branch_pool(min(len(branches), usable_cores()))
+            # the intra-op thread count is process wide: split it between the branches while they run, 
+            # so workers * threads stays within the cores instead of each branch claiming all of them
+            threads = torch.get_num_threads()
+            torch.set_num_threads(max(1, threads // pool._max_workers))
+            try:
+                futures = {f: pool.submit(self.branch, f, enc, layer, grad, masks.get(f), lengths.get(f)) for f in branches}
+                for f in branches:
+                    out[f] = futures[f].result()
+            finally:
+                torch.set_num_threads(threads)
+        else:
+            for f in branches:
+                out[f] = self.branch(f, enc, layer, grad, masks.get(f), lengths.get(f))
+        out.update({f"{f}_mask": m for f, m in masks.items()})
 
         if self.counter < 1 and "encoder" in self.debug:      
             s = enc.get("spectrogram")
@@ -826,6 +1212,75 @@ class AudioEncoder(nn.Module):
         self.counter += 1
         return out
 
+def benchmark_encoder_branches(features: Optional[List[str]] = None, batch: int = 2, dims: int = 256, head: int = 4, 
+                               layer: int = 2, ctx: int = 1500, mels: int = 128, runs: int = 5):
+    """Wall-clock of AudioEncoder.forward with the branches run sequentially vs concurrently."""
+    features = default(features, ["spectrogram", "waveform", "pitch", "envelope", "phase"])
+    encoder = AudioEncoder(mels=mels, ctx=ctx, dims=dims, head=head, layer=layer, debug=[], features=features).to(device).eval()
+    hop_length = 160
+    inputs = {"spectrogram": torch.randn(batch, mels, ctx), "envelope": torch.randn(batch, mels, ctx), 
+              "phase": torch.randn(batch, mels, ctx), "waveform": torch.randn(batch, 1, ctx * hop_length), 
+              "pitch": torch.randn(batch, 1, ctx * 2)}
+    inputs = {k: v for k, v in inputs.items() if k in features}
+    results = {}
+    with torch.no_grad():
+        for concurrent in (False, True):
+            encoder.concurrent = concurrent
+            encoder(inputs)
+            start = time.perf_counter()
+            for _ in range(runs):
+                encoder(inputs)
+            results["concurrent" if concurrent else "sequential"] = (time.perf_counter() - start) / runs
+    print(f"features={len(features)} sequential: {results['sequential']*1000:.1f} ms  "
+          f"concurrent: {results['concurrent']*1000:.1f} ms  speedup: {results['sequential'] / results['concurrent']:.2f}x")
+    return results
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """Mean cross-entropy of hidden @ weight.T against labels, projecting `chunk` tokens at a time."""
+    # only the per-token logsumexp is kept between forward and backward, never the (tokens, vocab) logits
+    @staticmethod
+    def forward(ctx, hidden, weight, labels, ignore_index, chunk):
+        h = hidden.reshape(-1, hidden.shape[-1])
+        y = labels.reshape(-1)
+        lse = torch.empty(h.shape[0], device=h.device, dtype=torch.float32)
+        total = h.new_zeros((), dtype=torch.float32)
+        for s in range(0, h.shape[0], chunk):
+            logits = (h[s:s + chunk] @ weight.T).float()
+            lse[s:s + chunk] = logits.logsumexp(dim=-1)
+            valid = y[s:s + chunk] != ignore_index
+            target = logits.gather(-1, y[s:s + chunk].clamp(0, logits.shape[-1] - 1).unsqueeze(-1)).squeeze(-1)
+            total += ((lse[s:s + chunk] - target) * valid).sum()
+        count = (y != ignore_index).sum()
+        ctx.save_for_backward(hidden, weight, labels, lse, count)
+        ctx.ignore_index, ctx.chunk = ignore_index, chunk
+        return total / count
+
+    @staticmethod
+    def backward(ctx, grad):
+        hidden, weight, labels, lse, count = ctx.saved_tensors
+        h = hidden.reshape(-1, hidden.shape[-1])
+        y = labels.reshape(-1)
+        scale = grad / count
+        grad_h = torch.empty_like(h) if ctx.needs_input_grad[0] else None
+        grad_w = torch.zeros_like(weight, dtype=torch.float32) if ctx.needs_input_grad[1] else None
+        for s in range(0, h.shape[0], ctx.chunk):
+            hc, yc = h[s:s + ctx.chunk], y[s:s + ctx.chunk]
+            probs = ((hc @ weight.T).float() - lse[s:s + ctx.chunk].unsqueeze(-1)).exp_()
+            valid = yc != ctx.ignore_index
+            rows = valid.nonzero().squeeze(-1)
+            probs[rows, yc[rows]] -= 1
+            probs *= (valid * scale).unsqueeze(-1)
+            if grad_h is not None:
+                grad_h[s:s + ctx.chunk] = probs.to(weight.dtype) @ weight
+            if grad_w is not None:
+                grad_w += probs.T @ hc.float()
+        grad_h = grad_h.view_as(hidden) if grad_h is not None else None
+        grad_w = grad_w.to(weight.dtype) if grad_w is not None else None
+        return grad_h, grad_w, None, None, None
+
+def chunked_cross_entropy(hidden: Tensor, weight: Tensor, labels: Tensor, ignore_index: int = 0, chunk: int = 1024) -> Tensor:
+    return ChunkedCrossEntropy.apply(hidden, weight, labels, ignore_index, chunk)
+
 class TextDecoder(nn.Module):
     def __init__(self, vocab: int, ctx: int, dims: int, head: int, layer: int, cross_attn: bool, 
                 debug: List[str], features: List[str]): 
@@ -841,6 +1296,8 @@ class TextDecoder(nn.Module):
         self.features = features
         self.do_blend = "no_blend" not in self.debug
         self.sequential = False 
+        self.fused = False
+        self._fused = {}
 
         self.token = nn.Embedding(num_embeddings=vocab, embedding_dim=dims)
         with torch.no_grad():
@@ -858,26 +1315,40 @@ class TextDecoder(nn.Module):
         self.blend = nn.ParameterDict({f: nn.Parameter(torch.tensor(0.5)) for f in features})
         self.ln_dec = RMSNorm(dims)
         
-        mask = torch.tril(torch.ones(ctx, ctx), diagonal=0)        
+        mask = torch.empty(ctx, ctx).fill_(-np.inf).triu_(1)
         self.register_buffer("mask", mask, persistent=False)
 
-    def forward(self, x, enc, order=None, layer='decoder') -> Tensor:
+    def forward(self, x, enc, order=None, layer='decoder', kv_cache: Optional[dict] = None, 
+                memory: Optional[dict] = None, key_mask: Optional[Tensor] = None, project: bool = True) -> Tensor:
 
         if order is None:
             order = self.features
-        
-        mask = self.mask[:x.shape[1], :x.shape[1]]
-        x = self.token(x) + self.positional[:x.shape[1]]
+
+        offset = kv_cache.get(self, 0) if kv_cache is not None else 0
+        mask = self.mask
+        x = self.token(x) + self.positional[offset:offset + x.shape[1]]
         x = F.dropout(x, p=self.dropout, training=self.training)
+        if kv_cache is not None:
+            kv_cache[self] = offset + x.shape[1]
         
         for block in self.block:
-            x = block(x, xa=None, mask=mask, enc=None, layer=layer)
+            x = block(x, xa=None, mask=mask, enc=None, layer=layer, kv_cache=kv_cache, offset=offset, key_mask=key_mask)
 
         for f in order:
             if f in enc:
                 xa = enc[f]
-                for block in self.blocks[f]:
-                    out = block(x=x, xa=xa, mask=None, enc=None, layer=layer)
+                xa_mask = enc.get(f"{f}_mask")
+                if self.fused and FusedResidual.supported(self.blocks[f]):
+                    # every block of a feature reads the same x and xa, so the whole stack fuses into one layer
+                    if f not in self._fused:
+                        self._fused[f] = FusedResidual(self.blocks[f])
+                    out = self._fused[f](x.expand(len(self.blocks[f]), *x.shape), xa=xa, mask=mask, layer=layer, 
+                                         kv_cache=kv_cache, offset=offset, memory=memory, key_mask=key_mask, 
+                                         xa_mask=xa_mask)[-1]
+                else:
+                    for block in self.blocks[f]:
+                        out = block(x=x, xa=xa, mask=mask, enc=None, layer=layer, kv_cache=kv_cache, offset=offset, 
+                                    memory=memory, key_mask=key_mask, xa_mask=xa_mask)
 
                 if self.sequential:
                     x = out
@@ -891,6 +1362,9 @@ class TextDecoder(nn.Module):
         self.counter += 1  
 
         x = self.ln_dec(x)   
+        return self.project(x) if project else x
+
+    def project(self, x: Tensor) -> Tensor:
         return x @ torch.transpose(self.token.weight.to(dtype), 0, 1).float()
 
 class Echo(nn.Module):
@@ -919,6 +1393,9 @@ class Echo(nn.Module):
             debug=param.debug,
             features=param.features,
             )
+        # tokens per chunk of the fused output projection + cross-entropy (chunked_cross_entropy); None
+        # computes the loss from the full logits
+        self.loss_chunk = None
         
     def forward(self,
         decoder_input_ids=None,
@@ -931,8 +1408,37 @@ class Echo(nn.Module):
         f0d: Optional[torch.Tensor]=None,
         envelope: Optional[torch.Tensor]=None,
         phase: Optional[torch.Tensor]=None,
+        lengths: Optional[Dict[str, torch.Tensor]]=None,
+        return_logits: Optional[bool]=None,
         ) -> Dict[str, torch.Tensor]:
+        # with loss_chunk and labels the full logits stay out of the graph; return_logits computes them without grad
+
+        encoder_outputs = self.encode(spectrogram=spectrogram, waveform=waveform, pitch=pitch, 
+                                      envelope=envelope, phase=phase, f0=f0, lengths=lengths)
+        key_mask = None
+        if lengths is not None and "input_ids" in lengths:
+            key_mask = length_mask(lengths["input_ids"].to(input_ids.device), input_ids.shape[1])
+        if labels is not None and self.loss_chunk:
+            hidden = self.decoder(input_ids, encoder_outputs, key_mask=key_mask, project=False)
+            loss = chunked_cross_entropy(hidden, self.decoder.token.weight.to(dtype), labels, ignore_index=0, 
+                                         chunk=self.loss_chunk)
+            logits = None
+            if default(return_logits, not self.training):
+                with torch.no_grad():
+                    logits = self.decoder.project(hidden)
+            return {"logits": logits, "loss": loss}
+
+        logits = self.decoder(input_ids, encoder_outputs, key_mask=key_mask)
+
+        loss = None
+        if labels is not None:
+            loss = F.cross_entropy(
+                logits.view(-1, logits.shape[-1]), labels.view(-1), ignore_index=0)
+                
+        return {"logits": logits, "loss": loss} 
 
+    def encode(self, spectrogram=None, waveform=None, pitch=None, envelope=None, phase=None, f0=None, 
+               lengths=None) -> Dict[str, Tensor]:
         encoder_inputs = {}
         if spectrogram is not None:
             encoder_inputs["spectrogram"] = spectrogram
@@ -946,16 +1452,124 @@ class Echo(nn.Module):
             encoder_inputs["phase"] = phase
         if f0 is not None:
             encoder_inputs["f0"] = f0
+        return self.encoder(encoder_inputs, lengths=lengths)
+
+    @torch.no_grad()
+    def generate(self, max_length: Optional[int] = None, bos_token_id: int = 1, eos_token_id: int = 2, 
+                 pad_token_id: int = 0, num_beams: int = 1, enc: Optional[Dict[str, Tensor]] = None, 
+                 memory: Optional[dict] = None, **kwargs) -> Tensor:
+        """Greedy decoding with cached K/V; num_beams > 1 dispatches to beam_search."""
+        if num_beams > 1:
+            return self.beam_search(max_length=max_length, num_beams=num_beams, bos_token_id=bos_token_id, 
+                                    eos_token_id=eos_token_id, pad_token_id=pad_token_id, enc=enc, memory=memory, 
+                                    **kwargs)
+        # enc / memory (see precompute_memory) carry encoder outputs and cross-attention K/V across calls
+        enc = enc if enc is not None else self.encode(**kwargs)
+        memory = default(memory, {})
+        batch = next(enc[f].shape[0] for f in self.param.features if f in enc)
+        max_length = min(default(max_length, self.param.text_ctx), self.param.text_ctx)
+
+        tokens = torch.full((batch, 1), bos_token_id, dtype=torch.long, device=self.device)
+        finished = torch.zeros(batch, dtype=torch.bool, device=self.device)
+        kv_cache = {}
+        x = tokens
+        for _ in range(max_length - 1):
+            logits = self.decoder(x, enc, kv_cache=kv_cache, memory=memory)[:, -1]
+            next_tokens = logits.argmax(dim=-1)
+            next_tokens = torch.where(finished, pad_token_id, next_tokens)
+            tokens = torch.cat([tokens, next_tokens.unsqueeze(-1)], dim=-1)
+            finished |= next_tokens == eos_token_id
+            if finished.all():
+                break
+            x = next_tokens.unsqueeze(-1)
+        return tokens
+
+    @torch.no_grad()
+    def beam_search(self, max_length: Optional[int] = None, num_beams: int = 4, length_penalty: float = 1.0,
+                    early_stopping: bool = True, bos_token_id: int = 1, eos_token_id: int = 2, 
+                    pad_token_id: int = 0, enc: Optional[Dict[str, Tensor]] = None, memory: Optional[dict] = None, 
+                    **features) -> Tensor:
+        """Beam search over one (batch * num_beams) decoder batch, ranked by score / length ** length_penalty."""
+        # finished hypotheses sit in a min-heap of at most num_beams per utterance, so the worst is heap[0]
+        enc = enc if enc is not None else self.encode(**features)
+        memory = default(memory, {})
+        batch = next(enc[f].shape[0] for f in self.param.features if f in enc)
+        max_length = min(default(max_length, self.param.text_ctx), self.param.text_ctx)
+        beams = num_beams
+        dev = self.device
+
+        tokens = torch.full((batch * beams, 1), bos_token_id, dtype=torch.long, device=dev)
+        scores = torch.zeros(batch, beams, device=dev)
+        scores[:, 1:] = -float("inf")
+        base = (torch.arange(batch, device=dev) * beams).unsqueeze(-1)
+        finished = [[] for _ in range(batch)]
+        push = lambda heap, h: heapq.heappush(heap, h) if len(heap) < beams else heapq.heappushpop(heap, h)
+        done = torch.zeros(batch, dtype=torch.bool, device=dev)
+        kv_cache = {}
+        x = tokens
+
+        for step in range(1, max_length):
+            logits = self.decoder(x, enc, kv_cache=kv_cache, memory=memory)[:, -1]
+            logprobs = F.log_softmax(logits.float(), dim=-1).view(batch, beams, -1)
+            vocab = logprobs.shape[-1]
+            cand_scores, cand_idx = (scores.unsqueeze(-1) + logprobs).view(batch, -1).topk(2 * beams, dim=-1)
+            cand_beam = cand_idx // vocab
+            cand_token = cand_idx % vocab
+            is_eos = cand_token == eos_token_id
+
+            for b, r in (is_eos[:, :beams] & ~done.unsqueeze(-1)).nonzero().tolist():
+                seq = tokens[b * beams + cand_beam[b, r]].tolist() + [eos_token_id]
+                push(finished[b], (cand_scores[b, r].item() / step ** length_penalty, seq))
+
+            rank = torch.arange(2 * beams, device=dev)
+            keep = (is_eos.long() * 2 * beams + rank).argsort(dim=-1)[:, :beams]
+            scores = cand_scores.gather(-1, keep)
+            index = (base + cand_beam.gather(-1, keep)).view(-1)
+            next_tokens = cand_token.gather(-1, keep).view(-1, 1)
+            tokens = torch.cat([tokens.index_select(0, index), next_tokens], dim=-1)
+            self._reorder_cache(kv_cache, index)
+
+            for b in (~done).nonzero().flatten().tolist():
+                if len(finished[b]) < beams:
+                    continue
+                if early_stopping:
+                    done[b] = True
+                else:
+                    done[b] = scores[b].max().item() / step ** length_penalty <= finished[b][0][0]
+            if done.all():
+                break
+            x = next_tokens
 
-        encoder_outputs = self.encoder(encoder_inputs)
-        logits = self.decoder(input_ids, encoder_outputs)
+        results = []
+        length = tokens.shape[1] - 1
+        for b in range(batch):
+            if not done[b]:
+                for r in range(beams):
+                    if scores[b, r] > -float("inf"):
+                        push(finished[b], (scores[b, r].item() / length ** length_penalty, tokens[b * beams + r].tolist()))
+            results.append(max(finished[b], key=lambda h: h[0])[1])
+        out = torch.full((batch, max(len(r) for r in results)), pad_token_id, dtype=torch.long, device=dev)
+        for b, seq in enumerate(results):
+            out[b, :len(seq)] = torch.tensor(seq, dtype=torch.long, device=dev)
+        return out
 
-        loss = None
-        if labels is not None:
-            loss = F.cross_entropy(
-                logits.view(-1, logits.shape[-1]), labels.view(-1), ignore_index=0)
-                
-        return {"logits": logits, "loss": loss} 
+    @torch.no_grad()
+    def precompute_memory(self, enc: Dict[str, Tensor]) -> dict:
+        """Cross-attention K/V of enc for every unfused decoder block, for generate(..., enc=, memory=)."""
+        # a fused stack keys its K/V by the FusedResidual and fills the same dict on its first step
+        memory = {}
+        for f in self.decoder.features:
+            if f in enc and not (self.decoder.fused and FusedResidual.supported(self.decoder.blocks[f])):
+                for block in self.decoder.blocks[f]:
+                    if block.attnb is not None:
+                        block.attnb.memory(enc[f], memory)
+        return memory
+
+    @staticmethod
+    def _reorder_cache(kv_cache: dict, index: Tensor):
+        for key, value in kv_cache.items():
+            if isinstance(value, tuple):
+                kv_cache[key] = tuple(t.index_select(0, index) for t in value)
 
     @property
     def device(self):
@@ -1013,101 +1627,181 @@ class Echo(nn.Module):
 
 @dataclass
 class DataCollator:
+    """Pads extract_features outputs into preallocated buffers; batch["lengths"] holds the unpadded sizes."""
     tokenizer: Any
+    pin_memory: bool = False
+    keys: Tuple[str, ...] = ("spectrogram", "waveform", "pitch", "f0", "envelope", "phase")
+
+    def empty(self, shape, dtype) -> Tensor:
+        # pinning initializes CUDA, which fails in forked DataLoader workers; their DataLoader pins instead
+        pin = self.pin_memory and torch.cuda.is_available() and torch.utils.data.get_worker_info() is None
+        return torch.empty(shape, dtype=dtype, pin_memory=pin)
+
+    def pad(self, items: List[Tensor], value) -> Tuple[Tensor, Tensor]:
+        lengths = [item.shape[-1] for item in items]
+        max_len = max(lengths)
+        out = self.empty((len(items), *items[0].shape[:-1], max_len), items[0].dtype)
+        for i, (item, n) in enumerate(zip(items, lengths)):
+            out[i, ..., :n].copy_(item)
+            out[i, ..., n:].fill_(value)
+        return out, torch.tensor(lengths, dtype=torch.long)
 
     def __call__(self, features: List[Dict[str, torch.Tensor]]) -> Dict[str, torch.Tensor]:
-        all_keys = set()
-        for f in features:
-            all_keys.update(f.keys())
+        if len(features) == 1 and isinstance(features[0], list):
+            features = features[0]  # a whole batch from BucketBatcher, loaded with batch_size=1
         batch = {}
         pad_token_id = getattr(self.tokenizer, 'pad_token_id', 0)
         bos_token_id = getattr(self.tokenizer, 'bos_token_id', 1)
         eos_token_id = getattr(self.tokenizer, 'eos_token_id', 2)
-
-        for key in all_keys:
-            if key == "label":
-                labels_list = [f["label"] for f in features]
-                max_len = max(len(l) for l in labels_list)  # noqa: E741
-                all_ids, all_labels = [], []
-                for label in labels_list:
-                    label_list = label.tolist() if isinstance(label, torch.Tensor) else label
-                    decoder_input = [bos_token_id] + label_list
-                    label_eos = label_list + [eos_token_id]
-                    input_len = max_len + 1 - len(decoder_input)
-                    label_len = max_len + 1 - len(label_eos)
-                    padded_input = decoder_input + [pad_token_id] * input_len
-                    padded_labels = label_eos + [pad_token_id] * label_len
-                    all_ids.append(padded_input)
-                    all_labels.append(padded_labels)
-                batch["input_ids"] = torch.tensor(all_ids, dtype=torch.long)
-                batch["labels"] = torch.tensor(all_labels, dtype=torch.long)
-            elif key in ["spectrogram", "waveform", "pitch", "f0", "env", "phase"]:
-                items = [f[key] for f in features if key in f]
-                max_len = max(item.shape[-1] for item in items)
-                padded = []
-                for item in items:
-                    pad_width = max_len - item.shape[-1]
-                    if pad_width > 0:
-                        pad_item = F.pad(item, (0, pad_width), mode='constant', value=pad_token_id)
-                    else:
-                        pad_item = item
-                    padded.append(pad_item)
-                batch[key] = torch.stack(padded)
-                if key == "spectrogram":
-                    batch["spectrogram"] = batch[key]
+        lengths = {}
+
+        if any("label" in f for f in features):
+            labels = [torch.as_tensor(f["label"], dtype=torch.long) for f in features]
+            n = torch.tensor([len(l) for l in labels], dtype=torch.long)  # noqa: E741
+            flat = torch.cat(labels)
+            width = int(n.max()) + 1
+            valid = torch.arange(width) < n.unsqueeze(-1)
+            input_ids = self.empty((len(labels), width), torch.long).fill_(pad_token_id)
+            input_ids[:, 0] = bos_token_id
+            input_ids[:, 1:][valid[:, :-1]] = flat
+            label_ids = self.empty((len(labels), width), torch.long).fill_(pad_token_id)
+            label_ids[valid] = flat
+            label_ids[torch.arange(len(labels)), n] = eos_token_id
+            batch["input_ids"] = input_ids
+            batch["labels"] = label_ids
+            lengths["input_ids"] = n + 1
+
+        for key in self.keys:
+            items = [f[key] for f in features if key in f]
+            if items:
+                batch[key], lengths[key] = self.pad([torch.as_tensor(item) for item in items], pad_token_id)
+        batch["lengths"] = lengths
         return batch
 
-def hilbert_transform(x):
-    N = x.shape[-1]
-    xf = torch.fft.rfft(x)
-    h = torch.zeros(N // 2 + 1, device=x.device, dtype=x.dtype)
-    if N % 2 == 0:
-        h[0] = h[N//2] = 1
-        h[1:N//2] = 2
-    else:
+class BucketBatcher(IterableDataset):
+    """Length-bucketed dynamic batches (lists of examples, for batch_size=1 and DataCollator) from a shuffle buffer."""
+    # a bucket is emitted once one more example would push longest x count over max_frames / max_tokens
+    def __init__(self, dataset, max_frames: int = 16000, max_tokens: int = 4096, max_batch: Optional[int] = None, 
+                 buckets: int = 8, boundaries: Optional[List[int]] = None, buffer_size: int = 1000, 
+                 shuffle: bool = True, drop_last: bool = False, key: Optional[str] = None, seed: int = 0):
+        self.dataset = dataset
+        self.max_frames = max_frames
+        self.max_tokens = max_tokens
+        self.max_batch = max_batch
+        self.buckets = buckets
+        self.boundaries = boundaries
+        self.buffer_size = buffer_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.key = key
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        if hasattr(self.dataset, "set_epoch"):
+            self.dataset.set_epoch(epoch)
+
+    def frames(self, example) -> int:
+        key = self.key or next(k for k in ("spectrogram", "waveform", "pitch", "f0") if k in example)
+        return example[key].shape[-1]
+
+    @staticmethod
+    def tokens(example) -> int:
+        return len(example["label"]) + 1 if "label" in example else 0
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        source = iter(self.dataset)
+        buffer = [(self.frames(e), self.tokens(e), e) for _, e in zip(range(self.buffer_size), source)]
+        edges = self.boundaries
+        if edges is None:
+            edges = np.unique(np.quantile([f for f, _, _ in buffer], np.linspace(0, 1, self.buckets + 1)[1:-1])) if buffer else []
+        bins = [[] for _ in range(len(edges) + 1)]
+
+        def fits(b, frames, tokens):
+            n = len(b) + 1
+            return ((self.max_batch is None or n <= self.max_batch) and 
+                    max([frames] + [f for f, _, _ in b]) * n <= self.max_frames and 
+                    max([tokens] + [t for _, t, _ in b]) * n <= self.max_tokens)
+
+        while buffer:
+            i = int(rng.integers(len(buffer))) if self.shuffle else 0
+            item, nxt = buffer[i], next(source, None)
+            if nxt is not None and self.shuffle:
+                buffer[i] = (self.frames(nxt), self.tokens(nxt), nxt)
+            else:
+                buffer.pop(i)
+                if nxt is not None:
+                    buffer.append((self.frames(nxt), self.tokens(nxt), nxt))
+            b = bins[int(np.searchsorted(edges, item[0], side="right"))]
+            if b and not fits(b, item[0], item[1]):
+                yield [e for _, _, e in b]
+                b.clear()
+            b.append(item)
+
+        if not self.drop_last:
+            for b in bins:
+                if b:
+                    yield [e for _, _, e in b]
+
+_hilbert_filters = {}
+
+def hilbert_filter(N: int, dim: int, ndim: int, device=None, dtype=None) -> Tensor:
+    """Cached analytic-signal weights over the rfft bins of a length-N axis (1 at DC and Nyquist, 2 between)."""
+    dim = dim % ndim
+    key = (N, dim, ndim, device, dtype)
+    h = _hilbert_filters.get(key)
+    if h is None:
+        h = torch.zeros(N // 2 + 1, device=device, dtype=dtype)
         h[0] = 1
-        h[1:(N+1)//2] = 2
-    return torch.fft.irfft(xf * h, n=N)
+        h[1:(N + 1) // 2] = 2
+        if N % 2 == 0:
+            h[N // 2] = 1
+        shape = [1] * ndim
+        shape[dim] = N // 2 + 1
+        h = _hilbert_filters[key] = h.view(shape)
+    return h
+
+def analytic_signal(x, dim=-1):
+    """x + i * hilbert(x) along dim: one rfft, the cached filter, and one complex ifft."""
+    N = x.shape[dim]
+    xf = torch.fft.rfft(x, dim=dim) * hilbert_filter(N, dim, x.ndim, x.device, x.dtype)
+    return torch.fft.ifft(xf, n=N, dim=dim)
 
-def analytic_signal(x):
-    return x + 1j * hilbert_transform(x)
+def hilbert_transform(x, dim=-1):
+    return analytic_signal(x, dim=dim).imag
 
 def hilbert_transform_2d(x, dim=-1):
-    N = x.shape[dim]
-    if dim == -1 or dim == len(x.shape) - 1:
-        xf = torch.fft.rfft(x)
-    else:
-        xf = torch.fft.rfft(x, dim=dim)
-    h_shape = [1] * len(x.shape)
-    h_shape[dim] = N // 2 + 1
-    h = torch.zeros(h_shape, device=x.device, dtype=x.dtype)
-    if dim == -1 or dim == len(x.shape) - 1:
-        if N % 2 == 0:
-            h[..., 0] = h[..., -1] = 1
-            h[..., 1:-1] = 2
-        else:
-            h[..., 0] = 1
-            h[..., 1:] = 2
-    else:
-        pass
-    return torch.fft.irfft(xf * h, n=N, dim=dim)
+    return hilbert_transform(x, dim=dim)
 
 def hilbert_transform_true_2d(x):
-    xf = torch.fft.rfft2(x)
-    h1, h2 = torch.meshgrid(
-        torch.fft.rfftfreq(x.shape[-2]) * 2 - 1,
-        torch.fft.rfftfreq(x.shape[-1]) * 2 - 1,
-        indexing='ij')
-    h = -1j / (math.pi * (h1 + 1j*h2))
-    h[0, 0] = 0 
-    return torch.fft.irfft2(xf * h.to(x.device))
-
-def process_spectrogram_with_hilbert(spec):
-    analytic = spec + 1j * hilbert_transform(spec)
-    envelope = torch.abs(analytic)
-    phase = torch.angle(analytic)
-    return envelope, phase
+    key = ("2d", x.shape[-2], x.shape[-1], x.device)
+    h = _hilbert_filters.get(key)
+    if h is None:
+        h1, h2 = torch.meshgrid(
+            torch.fft.rfftfreq(x.shape[-2]) * 2 - 1,
+            torch.fft.rfftfreq(x.shape[-1]) * 2 - 1,
+            indexing='ij')
+        h = -1j / (math.pi * (h1 + 1j*h2))
+        h[0, 0] = 0 
+        h = _hilbert_filters[key] = h.to(x.device)
+    return torch.fft.irfft2(torch.fft.rfft2(x) * h)
+
+def process_spectrogram_with_hilbert(spec, dim=-1):
+    analytic = analytic_signal(spec, dim=dim)
+    return analytic.abs(), analytic.angle()
         
+_transforms = {}
+
+def get_transform(kind: str, **config) -> nn.Module:
+    """torchaudio.transforms.<kind>(**config), built once per config and shared by later calls."""
+    key = (kind, tuple(sorted(config.items())))
+    transform = _transforms.get(key)
+    if transform is None:
+        transform = _transforms[key] = getattr(torchaudio.transforms, kind)(**config)
+    return transform
+
 def load_wave(wave_data, sample_rate):
     if isinstance(wave_data, str):
         waveform, sr = torchaudio.load(uri=wave_data, normalize=False)
@@ -1124,93 +1818,448 @@ def load_wave(wave_data, sample_rate):
         original_length = waveform.shape[1]
         target_length = int(original_length * (sample_rate / sr))  # noqa: F841
         
-        resampler = torchaudio.transforms.Resample(orig_freq=sr, new_freq=sample_rate)
+        resampler = get_transform("Resample", orig_freq=sr, new_freq=sample_rate)
         waveform = resampler(waveform)
         
     return waveform.flatten()
 
+def compare_f0(waves: List[np.ndarray], sampling_rate: int = 16000, hop_length: int = 128, **yin_kwargs) -> Dict[str, float]:
+    """yin_f0 against track_f0: voicing agreement, gross error rate (> 20% off) and mean cents error."""
+    lengths = torch.tensor([len(w) for w in waves])
+    batch = torch.zeros(len(waves), int(lengths.max()))
+    for i, w in enumerate(waves):
+        batch[i, :len(w)] = torch.as_tensor(w, dtype=torch.float32)
+    f0, voiced = yin_f0(batch, sampling_rate, hop_length, lengths=lengths, **yin_kwargs)
+    agree, total, gross, cents, both = 0, 0, 0, 0.0, 0
+    for i, w in enumerate(waves):
+        ref = torch.from_numpy(track_f0(w, sampling_rate, hop_length)).float()
+        est, v = f0[i, :len(ref)], voiced[i, :len(ref)]
+        ref_v = ref > 0
+        agree += (v == ref_v).sum().item()
+        total += len(ref)
+        m = v & ref_v
+        both += m.sum().item()
+        ratio = est[m] / ref[m]
+        gross += ((ratio - 1).abs() > 0.2).sum().item()
+        cents += (1200 * ratio.log2()).abs().sum().item()
+    results = {"voicing_agreement": agree / max(total, 1), "gross_error_rate": gross / max(both, 1), 
+               "mean_cents_error": cents / max(both, 1)}
+    print("  ".join(f"{k}: {v:.4f}" for k, v in results.items()))
+    return results
+
+def benchmark_f0(batch: int = 16, seconds: float = 5.0, sampling_rate: int = 16000, hop_length: int = 128, runs: int = 3):
+    """Utterances per second of pyworld one by one vs yin_f0 on the padded batch."""
+    t = torch.arange(int(seconds * sampling_rate)) / sampling_rate
+    freqs = torch.linspace(100, 300, batch).unsqueeze(-1)
+    waves = torch.sin(2 * math.pi * freqs * t * (1 + 0.1 * torch.sin(2 * math.pi * t))) + 0.01 * torch.randn(batch, len(t))
+    results = {}
+    start = time.perf_counter()
+    for _ in range(runs):
+        for w in waves.numpy():
+            track_f0(w, sampling_rate, hop_length)
+    results["pyworld"] = batch * runs / (time.perf_counter() - start)
+    with torch.no_grad():
+        yin_f0(waves.to(device), sampling_rate, hop_length)
+        start = time.perf_counter()
+        for _ in range(runs):
+            yin_f0(waves.to(device), sampling_rate, hop_length)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+    results["yin"] = batch * runs / (time.perf_counter() - start)
+    print(f"batch={batch} {seconds:.0f}s utterances/s pyworld: {results['pyworld']:.1f}  yin: {results['yin']:.1f}  "
+          f"speedup: {results['yin'] / results['pyworld']:.2f}x")
+    return results
+
+class PitchEngine:
+    """track_f0 over a batch of waveforms on a spawn process pool (pyworld holds the GIL), in input order."""
+    def __init__(self, workers: Optional[int] = None):
+        self.workers = workers or usable_cores()
+        self._pool = None
+
+    def __getstate__(self):
+        return {**self.__dict__, "_pool": None}
+
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def __call__(self, waves: List[np.ndarray], sampling_rate: Union[int, List[int]], hop_length: int) -> List[np.ndarray]:
+        rates = sampling_rate if isinstance(sampling_rate, (list, tuple)) else [sampling_rate] * len(waves)
+        if self.workers < 2 or len(waves) < 2:
+            return [track_f0(w, sr, hop_length) for w, sr in zip(waves, rates)]
+        chunksize = max(1, len(waves) // (4 * self.workers))
+        return list(self.pool().map(track_f0, waves, rates, [hop_length] * len(waves), chunksize=chunksize))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+def featurize_batch(waves: List[Tensor], sampling_rate: int, spectrogram, waveforms, pitch, frequency=False,
+                    hop_length=128, fmin=0, fmax=8000, n_mels=128, n_fft=1024, pad_mode="constant", center=True, 
+                    power=2.0, window_fn=torch.hann_window, mel_scale="htk", norm=None, normalized=False, 
+                    downsamples=False, period=False, hilbert=False, f0_tracks=None, f0_backend="pyworld", 
+                    engine=None) -> List[Dict[str, Tensor]]:
+    """The DSP half of extract_features for 1-d waveforms sharing one sampling rate, on the padded batch."""
+    # with constant padding each utterance's log-mel frames match running it alone
+    lengths = [len(w) for w in waves]
+    x = nn.utils.rnn.pad_sequence(list(waves), batch_first=True)
+    frames = [n // hop_length + 1 if center else (n - n_fft) // hop_length + 1 for n in lengths]
+    out = [{} for _ in waves]
+
+    if spectrogram:
+        transform = get_transform("MelSpectrogram", f_max=fmax, f_min=fmin, n_mels=n_mels, sample_rate=sampling_rate, 
+                                  n_fft=n_fft, hop_length=hop_length, norm=norm, normalized=normalized, power=power, 
+                                  center=center, mel_scale=mel_scale, window_fn=window_fn, pad_mode=pad_mode)
+        log_mel = torch.clamp(transform(x), min=1e-10).log10()
+        valid = length_mask(torch.tensor(frames), log_mel.shape[-1]).unsqueeze(1)
+        peak = log_mel.masked_fill(~valid, -np.inf).amax(dim=(-2, -1), keepdim=True)
+        spec = (torch.maximum(log_mel, peak - 8.0) + 4.0) / 4.0
+        for o, n, s in zip(out, frames, spec):
+            o["spectrogram"] = s[:, :n]
+
+        if hilbert:
+            for n in set(frames):
+                idx = [i for i, m in enumerate(frames) if m == n]
+                envelope, phase = process_spectrogram_with_hilbert(spec[idx, :, :n])
+                for j, i in enumerate(idx):
+                    out[i]["envelope"], out[i]["phase"] = envelope[j], phase[j]
+
+    if waveforms:
+        for o, w in zip(out, waves):
+            o["waveform"] = w.unsqueeze(0)
+
+    if pitch or frequency:
+        # one track feeds both outputs
+        if f0_tracks is None:
+            if f0_backend == "yin":
+                f0, _ = yin_f0(x, sampling_rate, hop_length, lengths=torch.tensor(lengths))
+                f0_tracks = [t[:n // hop_length + 1].double().numpy() for t, n in zip(f0, lengths)]
+            elif engine is not None:
+                f0_tracks = engine([w.numpy() for w in waves], sampling_rate, hop_length)
+            else:
+                f0_tracks = [track_f0(w.numpy(), sampling_rate, hop_length) for w in waves]
+        for o, track in zip(out, f0_tracks):
+            f0 = torch.from_numpy(track)
+            if pitch:
+                o["pitch"] = f0.unsqueeze(0)
+            if frequency:
+                o["f0"] = f0
+
+    if spectrogram and waveforms and pitch:
+        for o in out:
+            spec_mean = o["spectrogram"].mean()
+            spec_std = o["spectrogram"].std() + 1e-6
+            o["spectrogram"] = (o["spectrogram"] - spec_mean) / spec_std
+            
+            wav_mean = o["waveform"].mean()
+            wav_std = o["waveform"].std() + 1e-6
+            o["waveform"] = (o["waveform"] - wav_mean) / wav_std
+            
+            if o["pitch"].max() > 1.0:
+                pitch_min = 50.0
+                pitch_max = 500.0
+                o["pitch"] = (o["pitch"] - pitch_min) / (pitch_max - pitch_min)
+    return out
+
 def extract_features(batch, tokenizer, spectrogram, waveforms, pitch, frequency=False,
                      hop_length=128, fmin=0, fmax=8000, n_mels=128, n_fft=1024, sampling_rate=16000,
                      pad_mode="constant", center=True, power=2.0, window_fn=torch.hann_window, mel_scale="htk", 
-                     norm=None, normalized=False, downsamples=False, period=False, hilbert=False):
+                     norm=None, normalized=False, downsamples=False, period=False, hilbert=False, f0_track=None, 
+                     f0_backend="pyworld"):
 
     audio = batch["audio"]
-    sampling_rate = audio["sampling_rate"]
     sr = audio["sampling_rate"]
     wav = load_wave(wave_data=audio, sample_rate=sr)
-
-    if spectrogram:
-        transform = torchaudio.transforms.MelSpectrogram(
-            f_max=fmax,
-            f_min=fmin,
-            n_mels=n_mels,
-            sample_rate=sr,
-            n_fft=n_fft,
-            hop_length=hop_length,
-            norm=norm,
-            normalized=normalized,
-            power=power,
-            center=center, 
-            mel_scale=mel_scale,
-            window_fn=window_fn,
-            pad_mode=pad_mode)
-        
-        mel_spectrogram = transform(wav)      
-        log_mel = torch.clamp(mel_spectrogram, min=1e-10).log10()
-        log_mel = torch.maximum(log_mel, log_mel.max() - 8.0)
-        spec = (log_mel + 4.0) / 4.0
-        spec = torch.tensor(spec)
-        batch["spectrogram"] = spec
-        
-    if hilbert:
-        envelope_list = []
-        phase_list = []
-        
-        for ch_idx in range(spec.shape[0]):
-            envelope, phase = process_spectrogram_with_hilbert(spec[ch_idx])
-            envelope_list.append(envelope)
-            phase_list.append(phase)
+    batch.update(featurize_batch(
+        [wav], sr, spectrogram, waveforms, pitch, frequency=frequency, hop_length=hop_length, fmin=fmin, fmax=fmax, 
+        n_mels=n_mels, n_fft=n_fft, pad_mode=pad_mode, center=center, power=power, window_fn=window_fn, 
+        mel_scale=mel_scale, norm=norm, normalized=normalized, hilbert=hilbert, 
+        f0_tracks=None if f0_track is None else [f0_track], f0_backend=f0_backend)[0])
             
-        batch["envelope"] = torch.stack(envelope_list)
-        batch["phase"] = torch.stack(phase_list)
-        
-    wav_1d = wav.unsqueeze(0)
-    
-    if waveforms:
-        batch["waveform"] = wav_1d
-            
-    if pitch:
-        wav_np = wav.numpy().astype(np.float64)  
-        f0, t = pw.dio(wav_np, sampling_rate, 
-                    frame_period=hop_length/sampling_rate*1000)
-        f0 = pw.stonemask(wav_np, f0, t, sampling_rate)
-        f0 = torch.from_numpy(f0)
-        batch["pitch"] = f0.unsqueeze(0)
-        
-    if frequency:
-        wav_np = wav.numpy().astype(np.float64)  
-        f0, t = pw.dio(wav_np, sampling_rate, frame_period=hop_length/sampling_rate*1000)
-        f0 = pw.stonemask(wav_np, f0, t, sampling_rate)
-        f0 = torch.from_numpy(f0)  
-        batch["f0"] = f0
-                  
-    if spectrogram and waveforms and pitch:
-        spec_mean = batch["spectrogram"].mean()
-        spec_std = batch["spectrogram"].std() + 1e-6
-        batch["spectrogram"] = (batch["spectrogram"] - spec_mean) / spec_std
-        
-        wav_mean = batch["waveform"].mean()
-        wav_std = batch["waveform"].std() + 1e-6
-        batch["waveform"] = (batch["waveform"] - wav_mean) / wav_std
-        
-        if batch["pitch"].max() > 1.0:
-            pitch_min = 50.0
-            pitch_max = 500.0
-            batch["pitch"] = (batch["pitch"] - pitch_min) / (pitch_max - pitch_min)
-            
-    batch["label"] = tokenizer.encode(batch["transcription"], add_special_tokens=False)
+    if "transcription" in batch:
+        batch["label"] = tokenizer.encode(batch["transcription"], add_special_tokens=False)
     return batch
 
+class FeatureCache:
+    """extract_features outputs on disk in memmapped shards, keyed by a hash of the decoded audio and the config."""
+    # index.jsonl is appended only after the shard is flushed, so readers never see a partial entry; bump version
+    # when featurization changes what a config produces
+    version = 2
+    def __init__(self, root: str, config: Dict, fp16: bool = False, shard_bytes: int = 1 << 30):
+        self.config = config
+        self.fp16 = fp16
+        self.shard_bytes = shard_bytes
+        spec = json.dumps({"version": self.version, **{k: getattr(v, "__name__", v) for k, v in config.items()}}, 
+                          sort_keys=True, default=str)
+        self.root = os.path.join(root, hashlib.sha1(spec.encode()).hexdigest()[:16] + ("-fp16" if fp16 else ""))
+        os.makedirs(self.root, exist_ok=True)
+        self.index_path = os.path.join(self.root, "index.jsonl")
+        self.index = {}
+        self._index_pos = 0
+        self._maps = {}
+        self._shard = None
+        self._shard_id = 0
+        self._pid = None
+
+    def __getstate__(self):
+        # open shards and maps stay with the process that made them (dataloader workers get their own)
+        return {**self.__dict__, "_shard": None, "_maps": {}}
+
+    def __len__(self):
+        self.refresh()
+        return len(self.index)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get_entry(key) is not None
+
+    @staticmethod
+    def key(audio: Dict) -> str:
+        array = np.ascontiguousarray(audio["array"])
+        h = hashlib.blake2b(array.view(np.uint8), digest_size=16)
+        h.update(f"{audio.get('sampling_rate')}:{array.dtype}:{array.shape}".encode())
+        return h.hexdigest()
+
+    def refresh(self):
+        # entries appended since the last read, including by other processes
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "r") as f:
+            f.seek(self._index_pos)
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                entry = json.loads(line)
+                self.index[entry["key"]] = entry["features"]
+                self._index_pos += len(line.encode())
+
+    def get_entry(self, key: str) -> Optional[Dict]:
+        if key not in self.index:
+            self.refresh()
+        return self.index.get(key)
+
+    def read(self, shard: str, offset: int, shape: List[int], stored: str, dtype: str) -> Tensor:
+        stored = np.dtype(stored)
+        nbytes = int(np.prod(shape)) * stored.itemsize
+        mm = self._maps.get(shard)
+        if mm is None or offset + nbytes > len(mm):
+            mm = self._maps[shard] = np.memmap(os.path.join(self.root, shard), dtype=np.uint8, mode="r")
+        array = mm[offset:offset + nbytes].view(stored).reshape(shape)
+        return torch.from_numpy(np.array(array, dtype=np.dtype(dtype)))
+
+    def get(self, key: str) -> Optional[Dict[str, Tensor]]:
+        entry = self.get_entry(key)
+        if entry is None:
+            return None
+        return {name: self.read(*loc) for name, loc in entry.items()}
+
+    def put(self, key: str, features: Dict[str, Any]):
+        if self._shard is None or self._pid != os.getpid() or self._shard.tell() >= self.shard_bytes:
+            if self._shard is not None and self._pid == os.getpid():
+                self._shard.close()
+                self._shard_id += 1
+            self._pid = os.getpid()
+            self._shard_name = f"shard-{os.getpid()}-{self._shard_id}.bin"
+            self._shard = open(os.path.join(self.root, self._shard_name), "ab")
+        entry = {}
+        for name, value in features.items():
+            array = np.ascontiguousarray(value.numpy() if isinstance(value, Tensor) else np.asarray(value))
+            stored = np.float16 if self.fp16 and array.dtype.kind == "f" else array.dtype
+            offset = self._shard.tell()
+            self._shard.write(array.astype(stored, copy=False).tobytes())
+            entry[name] = [self._shard_name, offset, list(array.shape), np.dtype(stored).str, array.dtype.str]
+        self._shard.flush()
+        with open(self.index_path, "a") as f:
+            f.write(json.dumps({"key": key, "features": entry}) + "\n")
+        self.index[key] = entry
+
+def batch_extract_features(batch, tokenizer, engine: Optional[PitchEngine] = None, cache: Optional[FeatureCache] = None, 
+                           **dataset_config):
+    """dataset.map(batched=True) function: uncached utterances go through one featurize_batch call."""
+    examples = [dict(zip(batch, values)) for values in zip(*batch.values())]
+    keys = [FeatureCache.key(e["audio"]) for e in examples] if cache is not None else [None] * len(examples)
+    hits = [cache.get(k) if cache is not None else None for k in keys]
+    config = {k: v for k, v in dataset_config.items() if k != "sampling_rate"}
+    todo = [i for i, h in enumerate(hits) if h is None]
+    for sr in {examples[i]["audio"]["sampling_rate"] for i in todo}:
+        idx = [i for i in todo if examples[i]["audio"]["sampling_rate"] == sr]
+        waves = [load_wave(examples[i]["audio"], sr) for i in idx]
+        for i, features in zip(idx, featurize_batch(waves, sr, engine=engine, **config)):
+            examples[i].update(features)
+            if cache is not None:
+                cache.put(keys[i], features)
+    for e, hit in zip(examples, hits):
+        if hit is not None:
+            e.update(hit)
+    texts = [e for e in examples if "transcription" in e]
+    for e, label in zip(texts, tokenizer.encode_batch([e["transcription"] for e in texts], add_special_tokens=False)):
+        e["label"] = label
+    return {k: [e[k] for e in examples] for k in examples[0]} if examples else {}
+
+def audio_info(audio) -> Tuple[int, int]:
+    """(samples, sampling_rate) from the header of a path or an undecoded {"path", "bytes"} value."""
+    import soundfile as sf
+    if isinstance(audio, dict):
+        audio = io.BytesIO(audio["bytes"]) if audio.get("bytes") else audio["path"]
+    info = sf.info(audio)
+    return info.frames, info.samplerate
+
+class Manifest:
+    """Columnar per-utterance index (path, samples, rate, duration, text, token ids) built from file headers."""
+    def __init__(self, columns: Dict[str, np.ndarray]):
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns["path"])
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def tokens(self, i: int) -> np.ndarray:
+        offsets = self.columns["token_offsets"]
+        return self.columns["token_ids"][offsets[i]:offsets[i + 1]]
+
+    def select(self, index) -> "Manifest":
+        index = np.arange(len(self))[index]
+        offsets = self.columns["token_offsets"]
+        counts = offsets[index + 1] - offsets[index]
+        flat = np.concatenate([self.columns["token_ids"][offsets[i]:offsets[i + 1]] for i in index]) if len(index) else np.zeros(0, np.int32)
+        columns = {k: v[index] for k, v in self.columns.items() if k not in ("token_ids", "token_offsets")}
+        columns["token_ids"] = flat.astype(np.int32)
+        columns["token_offsets"] = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return Manifest(columns)
+
+    def filter(self, max_duration: Optional[float] = None, min_duration: float = 0.0, max_tokens: Optional[int] = None, 
+               min_tokens: int = 1) -> "Manifest":
+        keep = (self["duration"] > min_duration) & (self["num_tokens"] >= min_tokens)
+        if max_duration is not None:
+            keep &= self["duration"] < max_duration
+        if max_tokens is not None:
+            keep &= self["num_tokens"] < max_tokens
+        return self.select(np.flatnonzero(keep))
+
+    def shard(self, num_shards: int, index: int) -> "Manifest":
+        return self.select(np.arange(index, len(self), num_shards))
+
+    def buckets(self, boundaries: List[float]) -> List[np.ndarray]:
+        # row indices per duration bucket, edges in seconds
+        ids = np.searchsorted(boundaries, self["duration"], side="right")
+        return [np.flatnonzero(ids == b) for b in range(len(boundaries) + 1)]
+
+    def save(self, path: str):
+        np.savez(path, **self.columns)
+
+    @classmethod
+    def load(cls, path: str) -> "Manifest":
+        with np.load(path, allow_pickle=False) as data:
+            return cls({k: data[k] for k in data.files})
+
+    @classmethod
+    def build(cls, dataset, tokenizer, audio_column: str = "audio", text_column: str = "transcription", 
+              workers: Optional[int] = None, path: Optional[str] = None, chunk_size: int = 1024) -> "Manifest":
+        # headers only, chunk_size rows at a time, so undecoded audio bytes never outlive their chunk
+        if hasattr(dataset, "cast_column"):
+            dataset = dataset.cast_column(audio_column, Audio(decode=False))
+        workers = workers or min(32, (os.cpu_count() or 1) * 4)
+        paths, samples, rates, texts, ids = [], [], [], [], []
+        rows = iter(dataset)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                chunk = [(ex[audio_column], ex[text_column]) for ex in itertools.islice(rows, chunk_size)]
+                if not chunk:
+                    break
+                for n, sr in pool.map(audio_info, [a for a, _ in chunk]):
+                    samples.append(n)
+                    rates.append(sr)
+                paths += [a["path"] if isinstance(a, dict) else a for a, _ in chunk]
+                texts += [t for _, t in chunk]
+                ids += tokenizer.encode_batch([t for _, t in chunk], add_special_tokens=False)
+                del chunk
+        counts = np.array([len(t) for t in ids], dtype=np.int32)
+        samples = np.array(samples, dtype=np.int64)
+        rates = np.array(rates, dtype=np.int32)
+        manifest = cls({
+            "path": np.array(paths, dtype=np.str_),
+            "samples": samples,
+            "sampling_rate": rates,
+            "duration": (samples / np.maximum(rates, 1)).astype(np.float32),
+            "text": np.array(texts, dtype=np.str_),
+            "token_ids": np.array([i for t in ids for i in t], dtype=np.int32),
+            "token_offsets": np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+            "num_tokens": counts,
+        })
+        if path is not None:
+            manifest.save(path)
+        return manifest
+
+def merge_overlap(sequence: List[int], new_sequence: List[int], min_matches: int = 2) -> List[int]:
+    """Joins the token sequences of two overlapping windows at the best-matching shift."""
+    # left half of the aligned span from sequence, right half from new_sequence, where each window had more context
+    if not sequence or not new_sequence:
+        return sequence + new_sequence
+    left_all = np.asarray(sequence)
+    right_all = np.asarray(new_sequence)
+    best, best_i = 0.0, 0
+    for i in range(1, min(len(left_all), len(right_all)) + 1):
+        matches = int((left_all[-i:] == right_all[:i]).sum())
+        score = matches / i + i / 10000.0
+        if matches >= min_matches and score > best:
+            best, best_i = score, i
+    if best_i == 0:
+        return sequence + new_sequence
+    return sequence[:len(sequence) - best_i + best_i // 2] + new_sequence[best_i // 2:]
+
+@torch.no_grad()
+def wave_windows(audio, sample_rate: int, window: int, stride: int):
+    """Yields window-sample slices every stride samples, read from a file one window at a time."""
+    if isinstance(audio, dict) and audio.get("array") is not None:
+        wav = load_wave(wave_data=audio, sample_rate=sample_rate)
+        start = 0
+        while True:
+            yield wav[start:start + window]
+            if start + window >= wav.shape[0]:
+                return
+            start += stride
+    import soundfile as sf
+    if isinstance(audio, dict):
+        audio = io.BytesIO(audio["bytes"]) if audio.get("bytes") else audio["path"]
+    with sf.SoundFile(audio) as f:
+        scale = f.samplerate / sample_rate
+        start = 0
+        while True:
+            f.seek(int(start * scale))
+            wav = torch.from_numpy(f.read(math.ceil(window * scale), dtype="float32", always_2d=True).mean(-1))
+            if f.samplerate != sample_rate:
+                wav = get_transform("Resample", orig_freq=f.samplerate, new_freq=sample_rate)(wav)
+            yield wav[:window]
+            if (start + window) * scale >= f.frames:
+                return
+            start += stride
+
+def transcribe_long(model, audio, tokenizer, dataset_config: Dict, sample_rate: int = 16000, overlap: float = 0.2, 
+                    batch_size: int = 8, **generate_kwargs) -> str:
+    """Transcribes audio of any length in overlapping aud_ctx windows, batch_size windows at a time."""
+    # windows are read lazily from the source, so memory depends on batch_size and not on the input length
+    hop_length = dataset_config.get("hop_length", 128)
+    window = (model.param.aud_ctx - 1) * hop_length
+    stride = max(1, int(window * (1 - overlap)))
+    windows = wave_windows(audio, sample_rate, window, stride)
+    config = {**dataset_config, "sampling_rate": sample_rate}
+
+    collator = DataCollator(tokenizer=tokenizer)
+    keys = set(model.param.features) | {"f0", "lengths"}
+    merged = []
+    while True:
+        waves = list(itertools.islice(windows, batch_size))
+        if not waves:
+            break
+        batch = collator(featurize_batch(waves, **config))
+        tokens = model.generate(**{k: v for k, v in batch.items() if k in keys}, **generate_kwargs)
+        for seq in tokenizer.strip(tokens):
+            merged = merge_overlap(merged, seq)
+    return tokenizer.batch_decode([merged], skip_special_tokens=True)[0]
+
 def calculate_wer(reference, hypothesis):
     ref_words = reference.lower().split()
     hyp_words = hypothesis.lower().split()
@@ -1246,25 +2295,145 @@ def compute_wer_batch(references, hypotheses):
         total_wer += calculate_wer(ref, hyp)
     return total_wer / len(references)
 
-def compute_metrics(pred, compute_result: bool = True, print_pred: bool = False, num_samples: int = 0, tokenizer = None, model = None):
-
+def edit_ops(refs: List[List[int]], hyps: List[List[int]]) -> np.ndarray:
+    """(batch, 3) substitutions, insertions, deletions of padded integer sequences, one anti-diagonal at a time."""
+    # ties prefer substitution / match, then deletion, then insertion
+    B = len(refs)
+    m = np.array([len(r) for r in refs], dtype=np.int64)
+    n = np.array([len(h) for h in hyps], dtype=np.int64)
+    out = np.zeros((B, 3), dtype=np.int64)
+    if B == 0:
+        return out
+    M, N = int(m.max()), int(n.max())
+    R = np.full((B, max(M, 1)), -1, dtype=np.int64)
+    H = np.full((B, max(N, 1)), -2, dtype=np.int64)
+    for b in range(B):
+        R[b, :m[b]] = refs[b]
+        H[b, :n[b]] = hyps[b]
+    big = np.int64(1 << 40)
+    # cost, sub, ins, del of the cells (i, d - i) on the last two diagonals, indexed by i
+    prev2 = np.full((4, B, M + 1), big, dtype=np.int64)
+    prev1 = np.full((4, B, M + 1), big, dtype=np.int64)
+    ends = m + n
+    rows = np.arange(B)
+    for d in range(M + N + 1):
+        cur = np.full((4, B, M + 1), big, dtype=np.int64)
+        lo, hi = max(1, d - N), min(d - 1, M)
+        if lo <= hi:
+            i = np.arange(lo, hi + 1)
+            j = d - i
+            eq = R[:, i - 1] == H[:, j - 1]
+            diag = prev2[:, :, i - 1].copy()
+            diag[0] += ~eq
+            diag[1] += ~eq
+            dele = prev1[:, :, i - 1].copy()
+            dele[0] += 1
+            dele[3] += 1
+            ins = prev1[:, :, i].copy()
+            ins[0] += 1
+            ins[2] += 1
+            best = np.where(dele[0] < diag[0], dele, diag)
+            best = np.where(ins[0] < best[0], ins, best)
+            cur[:, :, lo:hi + 1] = best
+        if d <= N:
+            cur[:, :, 0] = np.array([d, 0, d, 0])[:, None]
+        if d <= M:
+            cur[:, :, d] = np.array([d, 0, 0, d])[:, None]
+        done = ends == d
+        if done.any():
+            out[done] = cur[1:, rows[done], m[done]].T
+        prev2, prev1 = prev1, cur
+    return out
+
+def _ops_chunk(pairs):
+    return edit_ops(*pairs)
+
+def error_counts(references: List[str], hypotheses: List[str], unit: str = "word", chunk: int = 512, 
+                 workers: int = 1) -> np.ndarray:
+    """(batch, 4) substitutions, insertions, deletions, reference length per utterance, in words or characters."""
+    if unit == "word":
+        vocab = {}
+        tokenize = lambda s: [vocab.setdefault(w, len(vocab)) for w in s.lower().split()]
+    elif unit == "char":
+        tokenize = lambda s: [ord(c) for c in s.lower()]
+    else:
+        raise ValueError(f"unit must be 'word' or 'char', got {unit!r}")
+    refs = [tokenize(r) for r in references]
+    hyps = [tokenize(h) for h in hypotheses]
+    order = sorted(range(len(refs)), key=lambda k: max(len(refs[k]), len(hyps[k])))
+    chunks = [order[k:k + chunk] for k in range(0, len(order), chunk)]
+    pairs = [([refs[k] for k in c], [hyps[k] for k in c]) for c in chunks]
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            results = list(pool.map(_ops_chunk, pairs))
+    else:
+        results = [_ops_chunk(p) for p in pairs]
+    counts = np.zeros((len(refs), 4), dtype=np.int64)
+    for c, ops in zip(chunks, results):
+        counts[c, :3] = ops
+    counts[:, 3] = [len(r) for r in refs]
+    return counts
+
+def error_rate(counts: np.ndarray) -> float:
+    """Corpus (S + I + D) / N in percent from error_counts rows; 0 or 100 when N is 0."""
+    total = np.asarray(counts).reshape(-1, 4).sum(0)
+    if total[3] == 0:
+        return 0.0 if total[:3].sum() == 0 else 100.0
+    return 100.0 * float(total[:3].sum()) / float(total[3])
+
+def corpus_wer(references: List[str], hypotheses: List[str], **kwargs) -> float:
+    return error_rate(error_counts(references, hypotheses, unit="word", **kwargs))
+
+def corpus_cer(references: List[str], hypotheses: List[str], **kwargs) -> float:
+    return error_rate(error_counts(references, hypotheses, unit="char", **kwargs))
+
+def benchmark_wer(utterances: int = 2000, words: int = 20, vocab: int = 500, error: float = 0.15, seed: int = 0):
+    """Seconds to score synthetic utterances with calculate_wer vs the batched error_counts."""
+    rng = np.random.default_rng(seed)
+    references, hypotheses = [], []
+    for _ in range(utterances):
+        ref = [f"w{t}" for t in rng.integers(0, vocab, rng.integers(1, 2 * words))]
+        hyp = [f"w{rng.integers(0, vocab)}" if rng.random() < error else w for w in ref if rng.random() > error / 2]
+        references.append(" ".join(ref))
+        hypotheses.append(" ".join(hyp))
+    results = {}
+    start = time.perf_counter()
+    loop = [calculate_wer(r, h) for r, h in zip(references, hypotheses)]
+    results["loop"] = time.perf_counter() - start
+    start = time.perf_counter()
+    counts = error_counts(references, hypotheses)
+    results["batched"] = time.perf_counter() - start
+    errors = counts[:, :3].sum(1)
+    per_utt = np.where(counts[:, 3] > 0, 100 * errors / np.maximum(counts[:, 3], 1), 100 * (errors > 0))
+    assert np.allclose(per_utt, loop), "batched edit distance disagrees with calculate_wer"
+    print(f"utterances={utterances} loop: {results['loop']:.3f} s  batched: {results['batched']:.3f} s  "
+          f"speedup: {results['loop'] / results['batched']:.2f}x  corpus WER: {error_rate(counts):.2f}")
+    return results
+
+def preprocess_logits_for_metrics(logits, labels):
+    # Trainer hook: reduce each eval batch to token ids on its device, so only ids reach the host
+    if isinstance(logits, tuple):
+        logits = logits[0]
+    return logits.argmax(dim=-1)
+
+def compute_metrics(pred, compute_result: bool = True, print_pred: bool = False, num_samples: int = 0, tokenizer = None, 
+                    model = None, state: Optional[dict] = None):
+    """WER / CER; with batch_eval_metrics, per-batch counts accumulate in `state` until compute_result."""
     pred_ids = pred.predictions
     label_ids = pred.label_ids
 
     if isinstance(pred_ids, tuple):
         pred_ids = pred_ids[0]
-    else:
-        pred_ids = pred_ids
-    if hasattr(pred_ids, "ndim") and pred_ids.ndim == 3:
-        if not isinstance(pred_ids, torch.Tensor):
-            pred_ids = torch.tensor(pred_ids)
+    if not isinstance(pred_ids, torch.Tensor):
+        pred_ids = torch.as_tensor(pred_ids)
+    if pred_ids.ndim == 3:
         pred_ids = pred_ids.argmax(dim=-1)
-
-    pred_ids = pred_ids.tolist()
-    label_ids = label_ids.tolist()
+    if not isinstance(label_ids, torch.Tensor):
+        label_ids = torch.as_tensor(label_ids)
 
     pad_token_id = tokenizer.pad_token_id if hasattr(tokenizer, 'pad_token_id') else 0
-    label_ids = [[pad_token_id if token == -100 else token for token in seq] for seq in label_ids]
+    pred_ids = pred_ids.masked_fill(pred_ids == -100, pad_token_id)
+    label_ids = label_ids.masked_fill(label_ids == -100, pad_token_id)
 
     if print_pred:
         pred_str = tokenizer.batch_decode(pred_ids, skip_special_tokens=False)
@@ -1272,13 +2441,23 @@ def compute_metrics(pred, compute_result: bool = True, print_pred: bool = False,
         for i in range(min(num_samples, len(pred_str))):
             print(f"Preds: {pred_str[i]}")
             print(f"Label: {label_str[i]}")
-            print(f"Preds: {pred_ids[i]}")
-            print(f"Label: {label_ids[i]}")
+            print(f"Preds: {pred_ids[i].tolist()}")
+            print(f"Label: {label_ids[i].tolist()}")
             print("--------------------------------")  
 
     pred_str = tokenizer.batch_decode(pred_ids, skip_special_tokens=True)
     label_str = tokenizer.batch_decode(label_ids, skip_special_tokens=True)
-    wer = compute_wer_batch(label_str, pred_str)
+    words = error_counts(label_str, pred_str).sum(0)
+    chars = error_counts(label_str, pred_str, unit="char").sum(0)
+
+    if state is not None:
+        words = state["words"] = state.get("words", 0) + words
+        chars = state["chars"] = state.get("chars", 0) + chars
+        if not compute_result:
+            return {}
+        state.clear()
+    wer = error_rate(words)
+    cer = error_rate(chars)
 
     if model is None:
         global global_model
@@ -1297,11 +2476,9 @@ def compute_metrics(pred, compute_result: bool = True, print_pred: bool = False,
         trainable_params = 0.0
         efficiency_score = 0.0
     
-    if hasattr(wer, "item"):
-        wer = wer.item()
-    
     metrics = {
         "wer": float(wer),
+        "cer": float(cer),
         "trainable_params_M": float(trainable_params),
         "efficiency_score": float(efficiency_score),
     }
@@ -1320,37 +2497,70 @@ def create_model(param: Dimensions) -> Echo:
     
     return model
 
-def setup_tokenizer(token: str, local_tokenizer_path: str = "./"):
-    from tokenizers import Tokenizer
-    tokenizer = Tokenizer.from_file(f"{local_tokenizer_path}/tokenizer.json")
-    orig_encode = tokenizer.encode
-    def enc(text, add_special_tokens=True):
-        ids = orig_encode(text).ids
-        if not add_special_tokens:
-            sp_ids = [tokenizer.token_to_id(t) for t in ["<PAD>", "<BOS>", "<EOS>"]]
-            ids = [id for id in ids if id not in sp_ids]
-        return ids
-
-    def bdec(ids_list, skip_special_tokens=True):
-        results = []
-        for ids in ids_list:
+class TokenizerAdapter:
+    """HF-style front end for a `tokenizers.Tokenizer`, using its Rust batch calls and array-wide stripping."""
+    def __init__(self, tokenizer, pad_token: str = "<PAD>", bos_token: str = "<BOS>", eos_token: str = "<EOS>"):
+        self.tokenizer = tokenizer
+        ids = [tokenizer.token_to_id(t) for t in (pad_token, bos_token, eos_token)]
+        self.pad_token_id, self.bos_token_id, self.eos_token_id = [i if i is not None else d for i, d in zip(ids, (0, 1, 2))]
+        self._special = frozenset((self.pad_token_id, self.bos_token_id, self.eos_token_id))
+        self.special_ids = np.array(sorted(self._special), dtype=np.int64)
+
+    def __getattr__(self, name):
+        if "tokenizer" not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.__dict__["tokenizer"], name)
+
+    def __len__(self):
+        return self.tokenizer.get_vocab_size()
+
+    def strip(self, ids, skip_special_tokens: bool = True) -> List[List[int]]:
+        # rows of ids without negative (ignore / padding) ids and, if asked, special ids
+        if isinstance(ids, torch.Tensor):
+            ids = ids.detach().cpu().numpy()
+        if isinstance(ids, np.ndarray) and ids.ndim == 2:
+            keep = ids >= 0
             if skip_special_tokens:
-                ids = [id for id in ids if id not in [0, 1, 2]]
-            results.append(tokenizer.decode(ids))
-        return results
+                keep &= ~np.isin(ids, self.special_ids)
+            flat, ends = ids[keep].tolist(), np.cumsum(keep.sum(1)).tolist()
+            return [flat[s:e] for s, e in zip([0] + ends[:-1], ends)]
+        # ragged Python lists: a set lookup per id is cheaper than building an array from them
+        drop = self._special if skip_special_tokens else ()
+        return [[i for i in row if i >= 0 and i not in drop] for row in ids]
+
+    def encode_batch(self, texts: List[str], add_special_tokens: bool = True) -> List[List[int]]:
+        ids = [e.ids for e in self.tokenizer.encode_batch(list(texts))]
+        return ids if add_special_tokens else self.strip(ids)
+
+    def encode(self, text, add_special_tokens: bool = True):
+        if isinstance(text, (list, tuple)):
+            return self.encode_batch(text, add_special_tokens=add_special_tokens)
+        return self.encode_batch([text], add_special_tokens=add_special_tokens)[0]
+
+    def decode_batch(self, ids, skip_special_tokens: bool = True) -> List[str]:
+        return self.tokenizer.decode_batch(self.strip(ids, skip_special_tokens), skip_special_tokens=skip_special_tokens)
+
+    batch_decode = decode_batch
+
+    def decode(self, ids, skip_special_tokens: bool = True) -> str:
+        if isinstance(ids, (torch.Tensor, np.ndarray)):
+            ids = ids.reshape(1, -1)
+        else:
+            ids = [list(ids)]
+        return self.decode_batch(ids, skip_special_tokens=skip_special_tokens)[0]
 
-    def save_pretrained(save_dir):
+    def save_pretrained(self, save_dir):
         os.makedirs(save_dir, exist_ok=True)
-        tokenizer.save(f"{save_dir}/tokenizer.json")
-    tokenizer.encode = enc
-    tokenizer.batch_decode = bdec
-    tokenizer.save_pretrained = save_pretrained
-    tokenizer.pad_token_id = 0
-    tokenizer.bos_token_id = 1
-    tokenizer.eos_token_id = 2
-    return tokenizer
-
-def prepare_datasets(tokenizer, token: str, sanity_check: bool = False, dataset_config: Optional[Dict] = None) -> Tuple[any, any]:
+        self.tokenizer.save(f"{save_dir}/tokenizer.json")
+
+def setup_tokenizer(token: str, local_tokenizer_path: str = "./") -> TokenizerAdapter:
+    from tokenizers import Tokenizer
+    return TokenizerAdapter(Tokenizer.from_file(f"{local_tokenizer_path}/tokenizer.json"))
+
+def prepare_datasets(tokenizer, token: str, sanity_check: bool = False, dataset_config: Optional[Dict] = None, 
+                     cache_dir: Optional[str] = "./output/features", cache_fp16: bool = False, 
+                     map_batch_size: int = 64, manifest: Optional[Manifest] = None, 
+                     engine: Optional[PitchEngine] = None) -> Tuple[any, any]:
     if dataset_config is None:
         dataset_config = {
             "spectrogram": True,
@@ -1377,32 +2587,48 @@ def prepare_datasets(tokenizer, token: str, sanity_check: bool = False, dataset_
 
     dataset = dataset.rename_column("sentence", "transcription")
     dataset = dataset.cast_column(column="audio", feature=Audio(sampling_rate=16000)).select_columns(["audio", "transcription"])
+    # features persist across epochs and runs; a changed dataset_config gets its own store
+    cache = FeatureCache(cache_dir, dataset_config, fp16=cache_fp16) if cache_dir is not None else None
+    prepare_fn = partial(batch_extract_features, tokenizer=tokenizer, engine=engine, cache=cache, **dataset_config)
     
     if sanity_check:
         dataset = dataset["test"].take(10)
         dataset = dataset.select_columns(["audio", "transcription"])
-        prepare_fn = partial(extract_features, tokenizer=tokenizer, **dataset_config)
-        dataset = dataset.map(function=prepare_fn, remove_columns=["audio", "transcription"]).with_format(type="torch")
+        dataset = dataset.map(function=prepare_fn, batched=True, batch_size=map_batch_size, 
+                              remove_columns=["audio", "transcription"]).with_format(type="torch")
         train_dataset = dataset
         test_dataset = dataset
     else:
+        # durations come from the manifest or the file header; nothing is decoded just to be rejected
+        known = {}
+        if manifest is not None:
+            keep = (manifest["duration"] > 0) & (manifest["duration"] * 16000 < 1500 * 160)
+            known = dict(zip(manifest["path"].tolist(), keep.tolist()))
+
         def filter_func(x):
-            return (0 < len(x["transcription"]) < 512 and
-                   len(x["audio"]["array"]) > 0 and
-                   len(x["audio"]["array"]) < 1500 * 160)
+            if not 0 < len(x["transcription"]) < 512:
+                return False
+            if x["audio"]["path"] in known:
+                return known[x["audio"]["path"]]
+            samples, sr = audio_info(x["audio"])
+            return 0 < samples * 16000 / sr < 1500 * 160
         
-        dataset = dataset.filter(filter_func)
-        prepare_fn = partial(extract_features, tokenizer=tokenizer, **dataset_config)
+        dataset = dataset.cast_column("audio", Audio(decode=False)).filter(filter_func)
+        dataset = dataset.cast_column("audio", Audio(sampling_rate=16000))
         train_dataset = dataset["train"]
         test_dataset = dataset["test"]
 
         train_dataset = train_dataset.map(
             function=prepare_fn, 
+            batched=True,
+            batch_size=map_batch_size,
             remove_columns=["audio", "transcription"]
         ).with_format(type="torch")
         
         test_dataset = test_dataset.map(
             function=prepare_fn, 
+            batched=True,
+            batch_size=map_batch_size,
             remove_columns=["audio", "transcription"]
         ).with_format(type="torch")
         
@@ -1458,7 +2684,7 @@ def main():
         if sanity:
             training_args = get_training_args(
             log_dir,
-            batch_eval_metrics = False,
+            batch_eval_metrics = True,
             max_steps = 10,
             save_steps = 0,
             eval_steps = 1,
@@ -1469,7 +2695,7 @@ def main():
         else:
             training_args = get_training_args(
             log_dir,
-            batch_eval_metrics = False,
+            batch_eval_metrics = True,
             max_steps = 1000,   
             save_steps = 1000,
             eval_steps = 100,   
@@ -1522,19 +2748,26 @@ def main():
         "normalized": False}
     
     model = create_model(param)
+    model.loss_chunk = 1024
     
     global global_model
     global_model = model
     
     metrics_fn = partial(compute_metrics, print_pred=False, num_samples=1, 
-                    tokenizer=tokenizer, model=model)
+                    tokenizer=tokenizer, model=model, state={})
     
     print(f"{'Sanity check' if sanity_check else 'Training'} mode")
+    # the datasets stream, so features (and the f0 pool) are computed while training runs
+    engine = PitchEngine()
     train_dataset, test_dataset = prepare_datasets(
         tokenizer=tokenizer,
         token=token,
         sanity_check=sanity_check,
-        dataset_config=dataset_config)
+        dataset_config=dataset_config, 
+        engine=engine)
+    # per_device_*_batch_size=1 now means one length-bucketed batch per step
+    train_dataset = BucketBatcher(train_dataset, max_frames=16000, max_tokens=4096)
+    test_dataset = BucketBatcher(test_dataset, max_frames=16000, max_tokens=4096, shuffle=False)
 
     optimizer = MaxFactor(model.parameters(), lr=0.025, beta2_decay=-0.8, eps=(1e-10, 1e-7), d=1.0, 
                  weight_decay=0.025, gamma=0.99, max=False)
@@ -1548,11 +2781,15 @@ def main():
         eval_dataset=test_dataset,
         data_collator=DataCollator(tokenizer=tokenizer),
         compute_metrics=metrics_fn,
+        preprocess_logits_for_metrics=preprocess_logits_for_metrics,
         optimizers=(optimizer, scheduler)
         ) 
        
     model.init_weights()
-    trainer.train()
+    try:
+        trainer.train()
+    finally:
+        engine.close()
 
 if __name__ == "__main__":
     main()
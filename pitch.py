@@ -0,0 +1,54 @@
+import os
+import math
+import numpy as np
+import pyworld as pw
+
+def usable_cores() -> int:
+    return (len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()) or 1
+
+def track_f0(wav: np.ndarray, sampling_rate: int, hop_length: int) -> np.ndarray:
+    """pyworld dio + stonemask f0, one frame per hop_length samples."""
+    wav = np.asarray(wav, dtype=np.float64)
+    f0, t = pw.dio(wav, sampling_rate, frame_period=hop_length/sampling_rate*1000)
+    return pw.stonemask(wav, f0, t, sampling_rate)
+
+def yin_f0(waves, sampling_rate: int, hop_length: int, fmin: float = 50.0, fmax: float = 800.0, 
+           threshold: float = 0.15, lengths=None):
+    """Batched YIN on (batch, samples) tensors: (f0, voiced), framed like track_f0 with 0 on unvoiced frames."""
+    # torch is imported here, not at the top, so PitchEngine workers load only numpy and pyworld
+    import torch
+    import torch.nn.functional as F
+
+    waves = waves.reshape(-1, waves.shape[-1]).float()
+    batch, samples = waves.shape
+    tau_min = max(1, int(sampling_rate // fmax))
+    tau_max = int(math.ceil(sampling_rate / fmin))
+    W = tau_max
+    frames = samples // hop_length + 1
+    x = F.pad(waves, (W // 2, W // 2 + tau_max + hop_length))
+    x = x.unfold(-1, W + tau_max, hop_length)[:, :frames]
+
+    n = 1 << (2 * W + tau_max - 1).bit_length()
+    r = torch.fft.irfft(torch.fft.rfft(x, n) * torch.fft.rfft(x[..., :W], n).conj(), n)[..., :tau_max + 1]
+    energy = F.pad(x.square().cumsum(-1), (1, 0))
+    taus = torch.arange(tau_max + 1, device=x.device)
+    # d(tau) = sum_j (x_j - x_{j+tau})^2 over the first W samples
+    d = (energy[..., W:W + 1] + energy[..., taus + W] - energy[..., taus] - 2 * r).clamp(min=0)
+    cum = d[..., 1:].cumsum(-1)
+    cmnd = torch.ones_like(d)
+    cmnd[..., 1:] = torch.where(cum > 1e-8 * W, d[..., 1:] * taus[1:] / cum.clamp(min=1e-12), torch.ones_like(cum))
+
+    inner = cmnd[..., 1:-1]
+    trough = (inner < cmnd[..., :-2]) & (inner <= cmnd[..., 2:]) & (inner < threshold)
+    trough[..., :tau_min - 1] = False
+    voiced = trough.any(-1)
+    tau = trough.float().argmax(-1, keepdim=True) + 1
+
+    # parabolic interpolation around the chosen lag
+    y0, y1, y2 = (cmnd.gather(-1, tau + o).squeeze(-1) for o in (-1, 0, 1))
+    denom = y0 - 2 * y1 + y2
+    shift = torch.where(denom.abs() > 1e-12, 0.5 * (y0 - y2) / denom, torch.zeros_like(denom)).clamp(-1, 1)
+    f0 = sampling_rate / (tau.squeeze(-1) + shift)
+    if lengths is not None:
+        voiced = voiced & (torch.arange(frames, device=x.device) < (lengths.to(x.device) // hop_length + 1).unsqueeze(-1))
+    return torch.where(voiced, f0, torch.zeros_like(f0)), voiced
@@ -0,0 +1,30 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from model_hf import DataCollator, Dimensions, Echo
+
+@pytest.mark.parametrize("debug", [set(), {"pbias"}])
+@pytest.mark.parametrize("fused", [False, True])
+def test_batched_sample_matches_alone_with_f0(debug, fused):
+    torch.manual_seed(0)
+    param = Dimensions(mels=16, aud_ctx=128, aud_head=2, aud_dims=32, aud_idx=2, vocab=50, text_ctx=16, text_head=2, 
+                       text_dims=32, text_idx=2, act="swish", debug=debug, cross_attn=True, 
+                       features=["spectrogram", "envelope"])
+    model = Echo(param)
+    model.load_state_dict({k: torch.randn_like(v) * 0.3 if v.dtype.is_floating_point and "theta" not in k else v 
+                           for k, v in model.state_dict().items()})
+    model.eval()
+    model.encoder.fused = model.decoder.fused = fused
+    # f0 runs at half the frame rate of the spectrogram, so it is resampled onto the encoder frames
+    items = [{"spectrogram": torch.randn(16, n), "envelope": torch.randn(16, n), "f0": torch.rand(n // 2) * 100 + 100, 
+              "label": torch.randint(3, 50, (6,))} for n in (100, 101)]
+    collator = DataCollator(tokenizer=SimpleNamespace(pad_token_id=0, bos_token_id=1, eos_token_id=2))
+    with torch.no_grad():
+        batched = model(**collator(items))["logits"]
+        for i, item in enumerate(items):
+            alone = model(**collator([item]))["logits"]
+            torch.testing.assert_close(batched[i], alone[0], atol=1e-4, rtol=1e-4)